@@ -1,9 +1,5 @@
 # New imports
-import os
-import shutil
-
-import pachyderm_sdk
-from pachyderm_sdk.api.pfs import File, FileType
+from pfs_download import PachDownloader
 
 # Old imports
 import pandas as pd
@@ -64,13 +60,6 @@ def get_train_and_validation_datasets(data_files, test_size=0.2, random_seed=42)
     
     return train_dataset, val_dataset
 
-# New - helper function used below
-def safe_open_wb(path):
-    ''' Open "path" for writing, creating any parent directories as needed.
-    '''
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    return open(path, 'wb')
-
 # New - helper function to download data from Pachyderm repository
 def download_pach_repo(
     pachyderm_host,
@@ -81,43 +70,13 @@ def download_pach_repo(
     token,
     project="default",
     previous_commit=None,
+    concurrency=None,
+    incremental=False,
 ):
     print(f"Starting to download dataset: {repo}@{branch} --> {root}")
 
-    if not os.path.exists(root):
-        os.makedirs(root)
-
-    client = pachyderm_sdk.Client(
-        host=pachyderm_host, port=pachyderm_port, auth_token=token
-    )
-    files = []
-    if previous_commit is not None:
-        for diff in client.pfs.diff_file(new_file=File.from_uri(f"{project}/{repo}@{branch}"),
-            old_file=File.from_uri(f"{project}/{repo}@{previous_commit}")
-        ):
-            src_path = diff.new_file.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if diff.new_file.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-    else:
-        for file_info in client.pfs.walk_file(file=File.from_uri(f"{project}/{repo}@{branch}")):
-            src_path = file_info.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if file_info.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-
-    for src_path, des_path in files:
-        src_file = client.pfs.pfs_file(file=File.from_uri(f"{project}/{repo}@{branch}:{src_path}"))
-        print(f"Downloading {src_path} to {des_path}")
-
-        with safe_open_wb(des_path) as dest_file:
-            shutil.copyfileobj(src_file, dest_file)
+    downloader = PachDownloader(pachyderm_host, pachyderm_port, token, concurrency)
+    files = downloader.download_repo(project, repo, branch, root, previous_commit, incremental)
 
     print("Download operation ended")
     return files
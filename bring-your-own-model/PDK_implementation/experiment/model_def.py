@@ -122,6 +122,7 @@ class ChurnTrial(PyTorchTrial):
             data_config["pachyderm"]["token"],
             data_config["pachyderm"]["project"],
             data_config["pachyderm"]["previous_commit"],
+            incremental=data_config["pachyderm"].get("incremental", False),
         )
         print(f"Data dir set to : {data_dir}")
 
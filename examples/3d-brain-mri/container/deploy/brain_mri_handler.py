@@ -1,7 +1,39 @@
+import itertools
+
 import numpy as np
 import torch
 from torch.profiler import ProfilerActivity
 from ts.torch_handler.image_classifier import ImageClassifier
+from ts.utils.util import PredictionException
+
+
+def window_starts(size, patch_size, overlap):
+    """Returns the start of each window of patch_size along a dimension of size.
+
+    Windows are overlap of a patch apart, the last one ending at the end of the dimension.
+    """
+    if size <= patch_size:
+        return [0]
+    stride = max(1, int(patch_size * (1 - overlap)))
+    starts = list(range(0, size - patch_size + 1, stride))
+    if starts[-1] != size - patch_size:
+        starts.append(size - patch_size)
+    return starts
+
+
+def gaussian_weights(patch_size, sigma_scale):
+    """Returns the (depth, height, width) Gaussian blending weights of a window.
+
+    The weight is 1 at the center of the window and decreases towards its borders,
+    with a standard deviation of sigma_scale times the window size per dimension.
+    """
+    weights = torch.ones(())
+    for size in patch_size:
+        coords = torch.arange(size, dtype=torch.float32) - (size - 1) / 2
+        axis = torch.exp(-0.5 * (coords / max(sigma_scale * size, 1e-6)) ** 2)
+        weights = weights.unsqueeze(-1) * axis
+    # Keep every voxel covered by at least one window with a non-zero weight.
+    return weights.clamp(min=1e-3)
 
 
 class BrainHandler(ImageClassifier):
@@ -10,6 +42,13 @@ class BrainHandler(ImageClassifier):
     default handler. This handler takes an image from the reqeust body (shape and values) and returns a mask as a tensor, stored in a list of dicts.
 
     Here method postprocess() and preprocess() have been overridden while others are reused from parent class.
+
+    Volumes larger than patch_size are segmented by sliding windows of patch_size, overlap
+    of a window apart, tile_batch_size windows per forward pass. The outputs of the windows
+    are blended with Gaussian weights. Only the windows of a forward pass are on the
+    device, so its memory does not depend on the size of the volume. The request body
+    can override patch_size, overlap, sigma_scale and tile_batch_size for that request
+    only.
     
     Author: Cyrill Hug / 01.17.2023
     Based on: https://github.dev/pytorch/serve/blob/master/examples/image_classifier/mnist/mnist_handler.py#L1 
@@ -21,6 +60,11 @@ class BrainHandler(ImageClassifier):
             "activities" : [ProfilerActivity.CPU],
             "record_shapes": True,
         }
+        # (depth, height, width) of the volumes of const.yaml, divisible by 8 due to VNet
+        self.patch_size = (144, 224, 224)
+        self.overlap = 0.5
+        self.sigma_scale = 0.125
+        self.tile_batch_size = 2
 
         
         
@@ -38,7 +82,69 @@ class BrainHandler(ImageClassifier):
 
         input_img = output.unsqueeze(0)
         
-        return input_img
+        return {"volume": input_img, "window": self.window_options(data[0])}
+
+    def window_options(self, request):
+        """Returns the sliding window options of request, the handler's by default.
+
+        Raises:
+            PredictionException: (400) if an option of request is invalid.
+        """
+        options = {
+            "patch_size": request.get("patch_size", self.patch_size),
+            "overlap": request.get("overlap", self.overlap),
+            "sigma_scale": request.get("sigma_scale", self.sigma_scale),
+            "tile_batch_size": request.get("tile_batch_size", self.tile_batch_size),
+        }
+        patch_size = options["patch_size"]
+        if (
+            not isinstance(patch_size, (list, tuple))
+            or len(patch_size) != 3
+            or not all(is_int(p) and p > 0 for p in patch_size)
+        ):
+            raise PredictionException(f"patch_size must be 3 positive integers, got {patch_size}", 400)
+        if not is_number(options["overlap"]) or not 0 <= options["overlap"] < 1:
+            raise PredictionException(f"overlap must be in [0, 1), got {options['overlap']}", 400)
+        if not is_number(options["sigma_scale"]) or options["sigma_scale"] <= 0:
+            raise PredictionException(f"sigma_scale must be positive, got {options['sigma_scale']}", 400)
+        if not is_int(options["tile_batch_size"]) or options["tile_batch_size"] < 1:
+            raise PredictionException(
+                f"tile_batch_size must be a positive integer, got {options['tile_batch_size']}", 400
+            )
+        return options
+
+    def inference(self, data, *args, **kwargs):
+        """Segments the (1, C, D, H, W) volume by Gaussian-blended sliding windows.
+
+        Args:
+            data (dict): The volume, on the CPU, and the window options returned by preprocess.
+        Returns:
+            tensor: The (1, classes, D, H, W) output of the model, on the CPU.
+        """
+        volume, options = data["volume"], data["window"]
+        tile_batch_size = options["tile_batch_size"]
+        volume_size = volume.shape[-3:]
+        patch_size = [min(p, size) for p, size in zip(options["patch_size"], volume_size)]
+        weights = gaussian_weights(patch_size, options["sigma_scale"])
+        windows = [
+            tuple(slice(start, start + p) for start, p in zip(starts, patch_size))
+            for starts in itertools.product(
+                *(window_starts(size, p, options["overlap"]) for size, p in zip(volume_size, patch_size))
+            )
+        ]
+
+        output, weight_sum = None, torch.zeros(volume_size)
+        with torch.no_grad():
+            for i in range(0, len(windows), tile_batch_size):
+                batch_windows = windows[i : i + tile_batch_size]
+                tiles = torch.cat([volume[(..., *window)] for window in batch_windows])
+                preds = self.model(tiles.to(self.device), *args, **kwargs).float().cpu()
+                if output is None:
+                    output = torch.zeros((1, preds.shape[1], *volume_size))
+                for window, pred in zip(batch_windows, preds):
+                    output[(0, slice(None), *window)] += pred * weights
+                    weight_sum[window] += weights
+        return output / weight_sum
         
 
     def postprocess(self, data):
@@ -51,3 +157,13 @@ class BrainHandler(ImageClassifier):
             list : A list with a tensor for the mask is returned
         """
         return data.tolist()
+
+
+def is_int(value):
+    """Returns whether value is an int of a JSON request (bools are ints in Python)."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    """Returns whether value is an int or float of a JSON request, not a bool."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
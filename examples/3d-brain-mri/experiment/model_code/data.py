@@ -1,16 +1,36 @@
+import hashlib
+import json
 import os
 import shutil
-import pachyderm_sdk
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import filelock
 import numpy as np
 import pandas as pd
 import nibabel as nib
-from model_code.utils import get_transforms
-from pachyderm_sdk.api.pfs import File, FileType
+import torch
+from model_code.pfs_download import PachDownloader
+from model_code.utils import PairedNormalize, crop_slices, get_transforms, volume_stats
 from pathlib import Path
 from torch.utils.data import Dataset
 from sklearn.model_selection import train_test_split
 
 
+def patient_paths(path_df, data_dir, patient):
+    """Returns the paths of the FLAIR, T1c, T2 and SWI volumes and of the mask of patient."""
+    volumes = path_df.loc[patient, 'volumes']
+    mask = path_df.loc[patient, 'masks']
+    return [os.path.join(data_dir, patient, name.strip('/')) for name in (*volumes, mask)]
+
+
+def load_patient(paths):
+    """Loads the (4, D, H, W) float32 volume and the (D, H, W) mask of patient_paths."""
+    vols = [nib.load(path).get_fdata(dtype=np.float32).T for path in paths[:4]]
+    vol_mask = nib.load(paths[4]).get_fdata(dtype=np.float32).T.astype(bool).astype(int)
+    return np.stack(vols), vol_mask
+
+
 class MRI_Dataset(Dataset):
     def __init__(self, path_df, data_dir, transform=None):
         self.path_df = path_df
@@ -22,16 +42,7 @@ class MRI_Dataset(Dataset):
     
     def __getitem__(self, idx):
         patient = self.path_df.index[idx]
-        mask = self.path_df.loc[patient, 'masks'].strip('/')
-        volumes = self.path_df.loc[patient, 'volumes']
-        vol_paths = [os.path.join(self.data_dir, patient, volume.strip('/')) for volume in volumes]
-        mask_path = os.path.join(self.data_dir, patient, mask)
-        vol_FLAIR = nib.load(vol_paths[0]).get_fdata(dtype=np.float32).T
-        vol_T1c = nib.load(vol_paths[1]).get_fdata(dtype=np.float32).T
-        vol_T2 = nib.load(vol_paths[2]).get_fdata(dtype=np.float32).T
-        vol_SWI = nib.load(vol_paths[3]).get_fdata(dtype=np.float32).T
-        vol_mask = nib.load(mask_path).get_fdata(dtype=np.float32).T.astype(bool).astype(int)
-        multimodal_vol = np.stack([vol_FLAIR,vol_T1c,vol_T2,vol_SWI])
+        multimodal_vol, vol_mask = load_patient(patient_paths(self.path_df, self.data_dir, patient))
         
         sample = (multimodal_vol, vol_mask)
               
@@ -39,16 +50,211 @@ class MRI_Dataset(Dataset):
             sample = self.transform(sample)
         
         return sample
-    
-   
-def get_train_val_datasets(download_dir, data_dir, trial_context):
-    
-    patients, volumes, masks = [], [], []
 
-    full_dir = "/"
-    full_dir = os.path.join(full_dir, download_dir.strip("/"), data_dir.strip("/"))
-    
-    print("full_dir = " + full_dir)
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of the content of path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_sources(sources_path, paths):
+    """
+    Returns whether the NIfTI files of paths are the ones recorded in sources_path.
+
+    sources_path lists the size, modification time and SHA-256 of each file. A file
+    whose size matches but whose modification time changed (e.g. downloaded again) is
+    hashed, and its new modification time recorded if the content is unchanged.
+    """
+    try:
+        with open(sources_path) as f:
+            sources = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if [source["name"] for source in sources] != [os.path.basename(path) for path in paths]:
+        return False
+
+    touched = False
+    for source, path in zip(sources, paths):
+        stat = os.stat(path)
+        if stat.st_size != source["size"]:
+            return False
+        if stat.st_mtime_ns != source["mtime_ns"]:
+            if file_digest(path) != source["sha256"]:
+                return False
+            source["mtime_ns"] = stat.st_mtime_ns
+            touched = True
+    if touched:
+        write_sources(sources_path, sources)
+    return True
+
+
+def source_records(paths):
+    """Returns the records of the NIfTI files of paths checked by check_sources."""
+    records = []
+    for path in paths:
+        stat = os.stat(path)
+        records.append({
+            "name": os.path.basename(path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_digest(path),
+        })
+    return records
+
+
+def write_sources(sources_path, sources):
+    """Atomically writes the records of source_records to sources_path."""
+    tmp_path = f"{sources_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w") as f:
+        json.dump(sources, f)
+    os.replace(tmp_path, sources_path)
+
+
+def write_volume_store(path_df, data_dir, store_dir, num_threads=4):
+    """
+    Converts the NIfTI volumes of the patients of path_df to the format of VolumeStoreDataset.
+
+    Each patient is written to store_dir/<patient>/ as image.npy, its (4, D, H, W) float32
+    volume, and mask.npy, its (D, H, W) uint8 mask: transposed, and cropped to the
+    dimensions divisible by 8 of crop_slices. foreground.npy lists the flat indices of
+    the voxels of the mask, stats.json the volume_stats of the volume and sources.json
+    the NIfTI files it was converted from. Patients already converted are skipped,
+    unless the content of one of their NIfTI files changed since (see check_sources).
+    Each patient is written to a temporary directory, renamed once complete.
+    """
+    def convert(patient):
+        paths = patient_paths(path_df, data_dir, patient)
+        des_dir = os.path.join(store_dir, patient)
+        if check_sources(os.path.join(des_dir, "sources.json"), paths):
+            return False
+
+        sources = source_records(paths)
+        imgs, mask = load_patient(paths)
+        slices = crop_slices(mask.shape)
+        imgs = imgs[(slice(None), *slices)]
+        tmp_dir = f"{des_dir}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "image.npy"), np.ascontiguousarray(imgs))
+        np.save(os.path.join(tmp_dir, "mask.npy"), mask[slices].astype(np.uint8))
+        np.save(os.path.join(tmp_dir, "foreground.npy"), np.flatnonzero(mask[slices]).astype(np.int32))
+        with open(os.path.join(tmp_dir, "stats.json"), "w") as f:
+            json.dump(volume_stats(imgs), f)
+        # Written last: a patient without sources.json is converted again.
+        write_sources(os.path.join(tmp_dir, "sources.json"), sources)
+        shutil.rmtree(des_dir, ignore_errors=True)
+        os.rename(tmp_dir, des_dir)
+        return True
+
+    os.makedirs(store_dir, exist_ok=True)
+    patients = path_df.index.unique()
+    with ThreadPoolExecutor(num_threads, thread_name_prefix="convert") as pool:
+        converted = sum(pool.map(convert, patients))
+    print(f"Converted {converted}/{len(patients)} patients to {store_dir}")
+
+
+class VolumeStoreDataset(Dataset):
+    """
+    Serves the patients of a store written by write_volume_store, as (4, D, H, W) volume
+    and (1, D, H, W) mask float tensors cropped as PairedToTensor and PairedCrop would.
+
+    The files are memory-mapped: only the crop is read, with no decompression nor
+    transposition. With a normalization, the crop is normalized by PairedNormalize with
+    the statistics of the whole volume computed by write_volume_store, before transform.
+    """
+    def __init__(self, store_dir, patients, depth=None, height=None, width=None, transform=None,
+                 normalization=None):
+        self.store_dir = store_dir
+        self.patients = list(patients)
+        self.crop = (depth, height, width)
+        self.transform = transform
+        self.normalize = PairedNormalize(normalization) if normalization else None
+
+    def __len__(self):
+        return len(self.patients)
+
+    def patient_dir(self, idx):
+        return os.path.join(self.store_dir, self.patients[idx])
+
+    def window(self, idx, shape):
+        """Returns the (depth, height, width) slices to read of sample idx, of the given shape."""
+        return crop_slices(shape, *self.crop)
+
+    def __getitem__(self, idx):
+        patient_dir = self.patient_dir(idx)
+        imgs = np.load(os.path.join(patient_dir, "image.npy"), mmap_mode="r")
+        mask = np.load(os.path.join(patient_dir, "mask.npy"), mmap_mode="r")
+        slices = self.window(idx, mask.shape)
+        imgs = torch.from_numpy(np.array(imgs[(slice(None), *slices)]))
+        masks = torch.from_numpy(mask[slices][None].astype(np.float32))
+
+        sample = (imgs, masks)
+
+        if self.normalize:
+            with open(os.path.join(patient_dir, "stats.json")) as f:
+                sample = self.normalize(sample, stats=json.load(f))
+
+        if self.transform:
+            sample = self.transform(sample)
+
+        return sample
+
+
+class VolumePatchDataset(VolumeStoreDataset):
+    """
+    Serves patches_per_volume random (depth, height, width) patches of each patient of a
+    store written by write_volume_store, as (4, d, h, w) volume and (1, d, h, w) mask
+    float tensors.
+
+    With probability foreground_ratio, a patch is centered on a random voxel of the
+    mask (when the mask is not empty), otherwise its position is uniform. Only the
+    patch is read from the memory-mapped files.
+    """
+    def __init__(
+        self,
+        store_dir,
+        patients,
+        depth,
+        height,
+        width,
+        patches_per_volume=8,
+        foreground_ratio=0.5,
+        transform=None,
+        normalization=None,
+    ):
+        super().__init__(store_dir, patients, depth, height, width, transform, normalization)
+        self.patches_per_volume = patches_per_volume
+        self.foreground_ratio = foreground_ratio
+
+    def __len__(self):
+        return len(self.patients) * self.patches_per_volume
+
+    def patient_dir(self, idx):
+        return super().patient_dir(idx // self.patches_per_volume)
+
+    def window(self, idx, shape):
+        """Returns the (depth, height, width) slices of a random patch of a volume of shape."""
+        # Dimensions should be divisible by 8 due to VNet architecture (as the stored ones)
+        patch_size = [min(size - size % 8, dim) for size, dim in zip(self.crop, shape)]
+        if np.random.random() < self.foreground_ratio:
+            foreground = np.load(os.path.join(self.patient_dir(idx), "foreground.npy"), mmap_mode="r")
+            if len(foreground):
+                center = np.unravel_index(foreground[np.random.randint(len(foreground))], shape)
+                starts = [
+                    min(max(c - size // 2, 0), dim - size)
+                    for c, size, dim in zip(center, patch_size, shape)
+                ]
+                return tuple(slice(start, start + size) for start, size in zip(starts, patch_size))
+        starts = [np.random.randint(dim - size + 1) for size, dim in zip(patch_size, shape)]
+        return tuple(slice(start, start + size) for start, size in zip(starts, patch_size))
+
+
+def list_patients(full_dir):
+    """Returns the DataFrame of the volumes and mask of each patient of full_dir."""
+    patients, volumes, masks = [], [], []
 
     all_patients = set(nifti_file.parent for nifti_file in Path(full_dir).rglob('*.nii*'))
     for patient_dir in all_patients:
@@ -63,12 +269,60 @@ def get_train_val_datasets(download_dir, data_dir, trial_context):
                         'volumes': volumes,
                         'masks': masks})
 
-    PathDF = PathDF.set_index('patients')
-    PathDF
+    return PathDF.set_index('patients')
+    
+   
+def get_train_val_datasets(download_dir, data_dir, trial_context, volume_store=False):
+
+    full_dir = "/"
+    full_dir = os.path.join(full_dir, download_dir.strip("/"), data_dir.strip("/"))
+    
+    print("full_dir = " + full_dir)
+
+    PathDF = list_patients(full_dir)
     
     train_patients, val_patients = train_test_split(PathDF.index.unique(), random_state = trial_context.get_hparam("split_seed"),
                                      test_size = trial_context.get_hparam("validation_ratio"))
 
+    if volume_store:
+        # Converted on first use, once for all the trials and slots.
+        store_dir = os.path.join("/", download_dir.strip("/"), "volumes", data_dir.strip("/"))
+        os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+        with filelock.FileLock(f"{store_dir}.lock"):
+            write_volume_store(PathDF, full_dir, store_dir)
+
+        # Normalized by the dataset, with the statistics precomputed for each volume.
+        train_transforms, eval_transforms = get_transforms(trial_context, pre_cropped=True)
+        normalization = trial_context.get_hparam("normalization")
+        crop = {
+            "depth": trial_context.get_hparam("volume_depth"),
+            "height": trial_context.get_hparam("volume_height"),
+            "width": trial_context.get_hparam("volume_width"),
+        }
+        hparams = trial_context.get_hparams()
+        patches_per_volume = hparams.get("patches_per_volume", 0)
+        if patches_per_volume:
+            # Train on random patches; validation still sees whole (cropped) volumes.
+            train_data = VolumePatchDataset(
+                store_dir,
+                train_patients,
+                hparams["patch_depth"],
+                hparams["patch_height"],
+                hparams["patch_width"],
+                patches_per_volume,
+                hparams.get("foreground_ratio", 0.5),
+                transform=train_transforms,
+                normalization=normalization,
+            )
+        else:
+            train_data = VolumeStoreDataset(
+                store_dir, train_patients, **crop, transform=train_transforms, normalization=normalization
+            )
+        valid_data = VolumeStoreDataset(
+            store_dir, val_patients, **crop, transform=eval_transforms, normalization=normalization
+        )
+        return train_data, valid_data
+
     train_transforms, eval_transforms = get_transforms(trial_context)
 
     train_data = MRI_Dataset(PathDF.loc[train_patients], full_dir, transform=train_transforms)
@@ -81,14 +335,6 @@ def get_train_val_datasets(download_dir, data_dir, trial_context):
 # ======================================================================================================================
 
 
-
-def safe_open_wb(path):
-    ''' Open "path" for writing, creating any parent directories as needed.
-    '''
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    return open(path, 'wb')
-
-
 def download_pach_repo(
     pachyderm_host,
     pachyderm_port,
@@ -98,59 +344,29 @@ def download_pach_repo(
     token,
     project="default",
     previous_commit=None,
+    concurrency=None,
+    incremental=False,
 ):
     print(f"Starting to download dataset: {repo}@{branch} --> {root}")
 
-    print(f'pachyderm_host = {pachyderm_host}')
-    print(f'pachyderm_port = {pachyderm_port}')
-    print(f'repo = {repo}')
-    print(f'branch = {branch}')
-    print(f'root = {root}')
-    print(f'token = {token}')
-    print(f'project = {project}')
-    print(f'previous_commit = {previous_commit}')
-    
-    print(f'DIR: {os.path.realpath("./")}')
-    print(f'CWD: {os.getcwd()}')
-    print(f'{root} -> {os.path.exists(root)}')
-
-    if not os.path.exists(root):
-        os.makedirs(root)
-
-    client = pachyderm_sdk.Client(
-        host=pachyderm_host, port=pachyderm_port, auth_token=token
-    )
-    files = []
-    if previous_commit is not None:
-        for diff in client.pfs.diff_file(new_file=File.from_uri(f"{project}/{repo}@{branch}"),
-            old_file=File.from_uri(f"{project}/{repo}@{previous_commit}")
-        ):
-            src_path = diff.new_file.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if diff.new_file.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-    else:
-        for file_info in client.pfs.walk_file(file=File.from_uri(f"{project}/{repo}@{branch}")):
-            src_path = file_info.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if file_info.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-
-    for src_path, des_path in files:
-        src_file = client.pfs.pfs_file(file=File.from_uri(f"{project}/{repo}@{branch}:{src_path}"))
-        print(f"Downloading {src_path} to {des_path}")
-
-        with safe_open_wb(des_path) as dest_file:
-            shutil.copyfileobj(src_file, dest_file)
+    downloader = PachDownloader(pachyderm_host, pachyderm_port, token, concurrency)
+    files = downloader.download_repo(project, repo, branch, root, previous_commit, incremental)
 
     print("Download operation ended")
     return files
 
 
-# ========================================================================================================
\ No newline at end of file
+# ========================================================================================================
+
+
+if __name__ == "__main__":
+    # Conversion as a pipeline step, from the experiment directory:
+    #   python -m model_code.data <NIfTI directory> <store directory>
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Converts NIfTI patients to a volume store.")
+    parser.add_argument("data_dir")
+    parser.add_argument("store_dir")
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    write_volume_store(list_patients(args.data_dir), args.data_dir, args.store_dir, args.threads)
@@ -33,7 +33,8 @@ class MRIVnetTrial(PyTorchTrial):
             self.train_dataset, self.val_dataset = data.get_train_val_datasets(
                 download_dir,
                 data_dir,
-                self.context
+                self.context,
+                self.data_config.get("volume_store", False),
             )
             self.num_batches = len(self.train_dataset)//self.context.get_global_batch_size()
         
@@ -55,20 +56,25 @@ class MRIVnetTrial(PyTorchTrial):
                 )
             )
             self.loss = diceloss.GeneralizedDiceLoss(classes=self.context.get_hparam("num_classes"))
+            # Volume stores normalize with the statistics precomputed for each volume.
+            self.batch_augment = utils.get_batch_augment(
+                self.context, normalize=not self.data_config.get("volume_store", False)
+            )
         else:
+            # The weights are loaded from the checkpoint: skip their initialization.
             self.model = vnet.VNet(
                         in_channels=self.context.get_hparam("input_channels"),
                         classes=self.context.get_hparam("num_classes"),
                         dropout=float(self.context.get_hparam("dropout")),
                         elu=self.context.get_hparam("elu")
             )
-            self.model.apply(utils.weights_init)
             self.model = self.context.wrap_model(self.model)
-            self.loss = diceloss.GeneralizedDiceLoss(classes=self.context.get_hparam("num_classes"))
     
 
     def train_batch(self, batch: TorchData, epoch_idx: int, batch_idx: int):
         imgs, masks = batch
+        if self.batch_augment:
+            imgs, masks = self.batch_augment(imgs, masks, train=True)
 
         with autocast():
             output = self.model(imgs)
@@ -87,6 +93,8 @@ class MRIVnetTrial(PyTorchTrial):
 
     def evaluate_batch(self, batch: TorchData):
         imgs, masks = batch
+        if self.batch_augment:
+            imgs, masks = self.batch_augment(imgs, masks, train=False)
 
         with autocast():
             output = self.model(imgs)
@@ -109,7 +117,8 @@ class MRIVnetTrial(PyTorchTrial):
             data_config["pachyderm"]["branch"],
             data_dir,
             data_config["pachyderm"]["token"],
-            data_config["pachyderm"]["project"]
+            data_config["pachyderm"]["project"],
+            incremental=data_config["pachyderm"].get("incremental", False),
         )
         print(f"Data dir set to : {data_dir}")
         return [des for src, des in files]
@@ -31,29 +31,123 @@ def tb_write_video(writer, name, imgs, masks, output, batch_idx):
     writer.flush()
 
 
-def get_transforms(trial_context):
-    train_transforms = transforms.Compose([                       
+def get_transforms(trial_context, pre_cropped=False):
+    # Samples of a VolumeStoreDataset are already cropped, normalized tensors.
+    to_cropped_tensor = [] if pre_cropped else [
         PairedToTensor(),
         PairedCrop(height=trial_context.get_hparam("volume_height"),
                    width=trial_context.get_hparam("volume_width"),
                    depth=trial_context.get_hparam("volume_depth")),
-        PairedNormalize(trial_context.get_hparam("normalization")),
+    ]
+    if trial_context.get_hparams().get("batch_augmentation", False):
+        # Normalized and augmented on the device, by get_batch_augment.
+        return transforms.Compose(to_cropped_tensor), transforms.Compose(to_cropped_tensor)
+
+    normalize = [] if pre_cropped else [PairedNormalize(trial_context.get_hparam("normalization"))]
+    train_transforms = transforms.Compose([
+        *to_cropped_tensor,
+        *normalize,
         PairedRandomAffine(degrees=(trial_context.get_hparam("affine_degrees_min"), trial_context.get_hparam("affine_degrees_max")),
                            translate=(trial_context.get_hparam("affine_translate_min"), trial_context.get_hparam("affine_translate_max")),
                            scale_ranges=(trial_context.get_hparam("affine_scale_min"), trial_context.get_hparam("affine_scale_max"))),
         PairedRandomHorizontalFlip(trial_context.get_hparam("hflip_pct"))
     ])
     eval_transforms = transforms.Compose([
-        PairedToTensor(),
-        PairedCrop(height=trial_context.get_hparam("volume_height"),
-                   width=trial_context.get_hparam("volume_width"),
-                   depth=trial_context.get_hparam("volume_depth")),
-        PairedNormalize(trial_context.get_hparam("normalization"))
+        *to_cropped_tensor,
+        *normalize,
     ])
 
     return train_transforms, eval_transforms
 
+def get_batch_augment(trial_context, normalize=True):
+    """Returns the BatchPairedAugment of the hyperparameters, or None if batch_augmentation is off.
+
+    normalize is False when the dataset already normalizes the volumes.
+    """
+    if not trial_context.get_hparams().get("batch_augmentation", False):
+        return None
+    return BatchPairedAugment(
+        degrees=(trial_context.get_hparam("affine_degrees_min"), trial_context.get_hparam("affine_degrees_max")),
+        translate=(trial_context.get_hparam("affine_translate_min"), trial_context.get_hparam("affine_translate_max")),
+        scale_ranges=(trial_context.get_hparam("affine_scale_min"), trial_context.get_hparam("affine_scale_max")),
+        hflip_prob=trial_context.get_hparam("hflip_pct"),
+        normalization=trial_context.get_hparam("normalization") if normalize else None,
+    )
+
 # Transforms
+class BatchPairedAugment():
+    """
+    Normalizes and augments batches of (N, C, D, H, W) volumes and (N, 1, D, H, W) masks on
+    their device, as PairedNormalize, PairedRandomAffine and PairedRandomHorizontalFlip do
+    per sample. CPU batches work the same, e.g. for testing.
+
+    Each sample gets its own rotation, scale and translation of the height-width plane, and
+    horizontal flip, all applied by a single grid_sample of the volume (bilinear) and of the
+    mask (nearest). translate is the maximum translation, as a fraction of (width, height).
+    The percentile normalization estimates the quantiles of each channel on num_samples
+    random voxels rather than sorting the whole volume; no normalization is applied when
+    normalization is None.
+    """
+    def __init__(self, degrees=(0, 0), translate=None, scale_ranges=None, hflip_prob=0.0,
+                 normalization='percentile', num_samples=2**16):
+        self.degrees = degrees
+        self.translate = translate or (0, 0)
+        self.scale_ranges = scale_ranges or (1, 1)
+        self.hflip_prob = hflip_prob
+        self.normalization = normalization
+        self.num_samples = num_samples
+
+    def normalize(self, imgs):
+        n, c = imgs.shape[:2]
+        flat = imgs.reshape(n, c, -1)
+        if self.normalization == 'zscore':
+            mean_vals = flat.mean(-1).reshape(n, c, 1, 1, 1)
+            std_vals = flat.std(-1).reshape(n, c, 1, 1, 1)
+            return (imgs - mean_vals)/std_vals
+        if self.normalization == 'min-max':
+            min_vals = flat.amin(-1).reshape(n, c, 1, 1, 1)
+            max_vals = flat.amax(-1).reshape(n, c, 1, 1, 1)
+            return (imgs - min_vals)/(max_vals - min_vals)
+        if flat.shape[-1] > self.num_samples:
+            flat = flat[..., torch.randint(flat.shape[-1], (self.num_samples,), device=imgs.device)]
+        q = torch.tensor([0.1, 0.99], device=imgs.device, dtype=flat.dtype)
+        imgs_min, imgs_max = torch.quantile(flat, q, dim=-1).reshape(2, n, c, 1, 1, 1)
+        return ((imgs - imgs_min)/(imgs_max - imgs_min)).clip(min=0, max=1)
+
+    def affine_grid(self, imgs):
+        n, _, d, h, w = imgs.shape
+        def uniform(low, high):
+            return torch.rand(n, device=imgs.device) * (high - low) + low
+
+        angle = torch.deg2rad(uniform(*self.degrees))
+        scale = uniform(*self.scale_ranges)
+        flip = torch.where(torch.rand(n, device=imgs.device) < self.hflip_prob, -1.0, 1.0)
+        # The grid maps the normalized coordinates (x, y, z) = (width, height, depth) of
+        #   the output to those of the input: rotations are made in pixels, hence the
+        #   aspect ratio.
+        cos, sin = torch.cos(angle) / scale, torch.sin(angle) / scale
+        theta = torch.zeros(n, 3, 4, device=imgs.device)
+        theta[:, 0, 0] = cos * flip
+        theta[:, 0, 1] = -sin * h / w
+        theta[:, 1, 0] = sin * w / h * flip
+        theta[:, 1, 1] = cos
+        theta[:, 2, 2] = 1
+        theta[:, 0, 3] = 2 * uniform(-self.translate[0], self.translate[0])
+        theta[:, 1, 3] = 2 * uniform(-self.translate[1], self.translate[1])
+        return torch.nn.functional.affine_grid(theta, (n, 1, d, h, w), align_corners=False)
+
+    def __call__(self, imgs, masks, train=True):
+        """Returns the normalized batch, and augmented if train."""
+        if self.normalization:
+            imgs = self.normalize(imgs)
+        if not train:
+            return imgs, masks
+        grid = self.affine_grid(imgs).to(imgs.dtype)
+        imgs = torch.nn.functional.grid_sample(imgs, grid, mode='bilinear', align_corners=False)
+        masks = torch.nn.functional.grid_sample(masks, grid.to(masks.dtype), mode='nearest', align_corners=False)
+        return imgs, masks
+
+
 class PairedRandomHorizontalFlip():
     """Custom transform for horizontal flipping"""
     def __init__(self, prob=0.5):
@@ -115,6 +209,25 @@ class PairedToTensor():
         imgs, masks = torch.FloatTensor(imgs), torch.FloatTensor(masks)
         return imgs, masks
 
+def crop_slices(shape, depth=None, height=None, width=None):
+    """
+    Returns the (depth, height, width) slices of the centered crop of PairedCrop
+    for a volume of the given (..., depth, height, width) shape.
+
+    Sizes that are missing or larger than the volume are clipped to it; the crop is
+    then rounded down to a multiple of 8. Cropping with the slices of crop_slices(shape)
+    first does not change the result of a later crop.
+    """
+    slices = []
+    for old_size, new_size in zip(shape[-3:], (depth, height, width)):
+        if not new_size or new_size > old_size:
+            new_size = old_size
+        # Dimensions should be divisible by 8 due to VNet architecture
+        delta = old_size - new_size + new_size % 8
+        crop_left = delta // 2
+        slices.append(slice(crop_left, old_size - (delta - crop_left)))
+    return tuple(slices)
+
 class PairedCrop():
     """
     Crop Tensors to correct dimension without interpolating.
@@ -149,6 +262,20 @@ class PairedCrop():
 
         return imgs, masks
 
+def volume_stats(imgs):
+    """
+    Returns the per-channel statistics of a (C, D, H, W) volume that PairedNormalize uses,
+    as lists: the 'percentile' 0.1 and 0.99 quantiles, 'mean', 'std', 'min' and 'max'.
+    """
+    flat = np.asarray(imgs, dtype=np.float64).reshape(len(imgs), -1)
+    return {
+        'percentile': np.quantile(flat, [0.1, 0.99], axis=1).tolist(),
+        'mean': flat.mean(axis=1).tolist(),
+        'std': flat.std(axis=1, ddof=1).tolist(),
+        'min': flat.min(axis=1).tolist(),
+        'max': flat.max(axis=1).tolist(),
+    }
+
 class PairedNormalize():
     """
     Normalize voxel intensity by volume z-score, percentiles or max-min
@@ -156,23 +283,39 @@ class PairedNormalize():
     def __init__(self, normalization='percentile'):
         self.normalization = normalization
 
-    def __call__(self, sample):
+    def __call__(self, sample, stats=None):
+        """
+        Normalizes the volume of sample, with the volume_stats stats if given rather than
+        with the statistics of the volume itself.
+        """
         imgs, masks = sample
         n_channels = imgs.shape[0]
 
+        def stat(name):
+            return torch.tensor(stats[name], dtype=imgs.dtype).reshape(-1,n_channels,1,1,1)
+
         if self.normalization == 'zscore':
-            mean_vals = imgs.mean(axis=(1,2,3)).reshape(n_channels,1,1,1)
-            std_vals = imgs.std(axis=(1,2,3)).reshape(n_channels,1,1,1)
+            if stats is not None:
+                mean_vals, std_vals = stat('mean')[0], stat('std')[0]
+            else:
+                mean_vals = imgs.mean(axis=(1,2,3)).reshape(n_channels,1,1,1)
+                std_vals = imgs.std(axis=(1,2,3)).reshape(n_channels,1,1,1)
             imgs_norm = (imgs - mean_vals)/std_vals
         elif self.normalization == 'min-max':
-            min_vals = imgs.amin(axis=(1,2,3)).reshape(n_channels,1,1,1)
-            max_vals = imgs.amax(axis=(1,2,3)).reshape(n_channels,1,1,1)
+            if stats is not None:
+                min_vals, max_vals = stat('min')[0], stat('max')[0]
+            else:
+                min_vals = imgs.amin(axis=(1,2,3)).reshape(n_channels,1,1,1)
+                max_vals = imgs.amax(axis=(1,2,3)).reshape(n_channels,1,1,1)
             imgs_norm = (imgs - min_vals)/(max_vals-min_vals)
         else:
             if self.normalization != 'percentile':
                 print('Defaulting to 1st and 99th percentile normalization')
-            imgs_min, imgs_max = torch.quantile(imgs.reshape(n_channels,-1), torch.tensor([0.1,0.99]), dim=-1)
-            imgs_min, imgs_max = imgs_min.reshape(n_channels,1,1,1), imgs_max.reshape(n_channels,1,1,1)
+            if stats is not None:
+                imgs_min, imgs_max = stat('percentile')
+            else:
+                imgs_min, imgs_max = torch.quantile(imgs.reshape(n_channels,-1), torch.tensor([0.1,0.99]), dim=-1)
+                imgs_min, imgs_max = imgs_min.reshape(n_channels,1,1,1), imgs_max.reshape(n_channels,1,1,1)
             imgs_norm = ((imgs - imgs_min)/(imgs_max - imgs_min)).clip(min=0, max=1)
         
         return imgs_norm, masks
\ No newline at end of file
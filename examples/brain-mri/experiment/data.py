@@ -1,36 +1,46 @@
+import hashlib
 import os
 import shutil
 
 import cv2
+import filelock
 import numpy as np
-import pachyderm_sdk
 import pandas as pd
 import torch
-from pachyderm_sdk.api.pfs import File, FileType
 from PIL import Image
 from skimage import io
 from sklearn.model_selection import train_test_split
 from torch.utils.data import DataLoader, Dataset
 from torchvision import transforms
 
+from pfs_download import PachDownloader
+
 
 class MRI_Dataset(Dataset):
     def __init__(self, path_df, data_dir, transform=None):
-        self.path_df = path_df
         self.transform = transform
         self.data_dir = data_dir
+
+        # The absolute paths are joined once, into two contiguous arrays of encoded
+        #   paths: no DataFrame lookup per sample, and pickling the dataset into the
+        #   DataLoader workers copies two buffers instead of a DataFrame.
+        base_paths = [os.path.join(data_dir, d.strip("/")) for d in path_df['directory']]
+        self.image_paths = np.array(
+            [os.fsencode(os.path.join(b, f)) for b, f in zip(base_paths, path_df['images'])],
+            dtype=np.bytes_,
+        )
+        self.mask_paths = np.array(
+            [os.fsencode(os.path.join(b, f)) for b, f in zip(base_paths, path_df['masks'])],
+            dtype=np.bytes_,
+        )
         
     def __len__(self):
-        return self.path_df.shape[0]
+        return len(self.image_paths)
     
     def __getitem__(self, idx):
         
-        base_path = os.path.join(self.data_dir, self.path_df.iloc[idx]['directory'].strip("/"))
-        img_path = os.path.join(base_path, self.path_df.iloc[idx]['images'])
-        mask_path = os.path.join(base_path, self.path_df.iloc[idx]['masks'])
-        
-        image = Image.open(img_path)
-        mask = Image.open(mask_path)
+        image = Image.open(os.fsdecode(self.image_paths[idx]))
+        mask = Image.open(os.fsdecode(self.mask_paths[idx]))
         
         sample = (image, mask)
         
@@ -50,8 +60,171 @@ class PairedToTensor():
         img = img/255
         mask = mask/255
         return img, mask
+
+
+def relative_image_paths(path_df):
+    """Returns the image paths of path_df relative to the data directory, as bytes."""
+    return [
+        os.fsencode(os.path.join(d.strip("/"), f))
+        for d, f in zip(path_df['directory'], path_df['images'])
+    ]
+
+
+def source_paths(path_df, data_dir):
+    """Returns the (image, mask) paths of the pairs of path_df."""
+    return [
+        (os.path.join(data_dir, d.strip("/"), image), os.path.join(data_dir, d.strip("/"), mask))
+        for d, image, mask in zip(path_df['directory'], path_df['images'], path_df['masks'])
+    ]
+
+
+def source_stats(pairs):
+    """Returns the sizes and modification times (ns) of pairs, as two (N, 2) int64 arrays."""
+    stats = [[os.stat(path) for path in pair] for pair in pairs]
+    sizes = np.array([[st.st_size for st in pair] for pair in stats], dtype=np.int64).reshape(-1, 2)
+    mtimes = np.array([[st.st_mtime_ns for st in pair] for pair in stats], dtype=np.int64).reshape(-1, 2)
+    return sizes, mtimes
+
+
+def source_digests(pairs):
+    """Returns the SHA-256 of the image followed by the mask of each of pairs, as a (N,) array."""
+    digests = []
+    for pair in pairs:
+        digest = hashlib.sha256()
+        for path in pair:
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+        digests.append(digest.digest())
+    return np.array(digests, dtype="S32")
+
+
+def write_packed_store(path_df, data_dir, directory):
+    """Packs the image/mask pairs of path_df into the format of PackedMRIDataset.
+
+    Row i of pairs.npy, a (N, 4, H, W) uint8 array, holds the 3 channels of pair i
+      followed by its mask; paths.npy lists the image path of each row, relative to
+      data_dir, and sizes.npy, mtimes.npy and digests.npy the source_stats and
+      source_digests of the files the row was packed from. The store is written to a temporary directory, renamed to
+      directory once complete: callers sharing directory must hold a lock on it.
+    """
+    dataset = MRI_Dataset(path_df, data_dir)
+    if not len(dataset):
+        raise ValueError(f"No image/mask pair to pack from {data_dir}")
+
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    pairs = None
+    for idx in range(len(dataset)):
+        image, mask = (np.asarray(x) for x in dataset[idx])
+        if pairs is None:
+            pairs = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, "pairs.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(dataset), 4) + mask.shape,
+            )
+        if image.shape != mask.shape + (3,):
+            raise ValueError(
+                f"{os.fsdecode(dataset.image_paths[idx])}: expected a {pairs.shape[2:]} RGB "
+                f"image and mask, got {image.shape} and {mask.shape}"
+            )
+        pairs[idx, :3] = np.moveaxis(image, -1, 0)
+        pairs[idx, 3] = mask
+    pairs.flush()
+    del pairs
+    np.save(os.path.join(tmp_dir, "paths.npy"), np.array(relative_image_paths(path_df), dtype=np.bytes_))
+    pairs = source_paths(path_df, data_dir)
+    sizes, mtimes = source_stats(pairs)
+    np.save(os.path.join(tmp_dir, "sizes.npy"), sizes)
+    np.save(os.path.join(tmp_dir, "mtimes.npy"), mtimes)
+    np.save(os.path.join(tmp_dir, "digests.npy"), source_digests(pairs))
+    print(f"Packed {len(dataset)} image/mask pairs to {directory}")
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp_dir, directory)
+
+
+def packed_rows(path_df, directory, data_dir=None):
+    """Returns the rows of the packed store of directory holding the pairs of path_df.
+
+    Raises KeyError when the store is missing a pair of path_df. When data_dir is
+      given, also raises KeyError when a pair of data_dir differs from the files it
+      was packed from. Only the pairs whose size matches but whose modification time
+      changed (e.g. downloaded again) are hashed; the modification times of those
+      found unchanged are then updated in the store, so callers must hold its lock.
+    """
+    rows = {p: row for row, p in enumerate(np.load(os.path.join(directory, "paths.npy")))}
+    rows = np.array([rows[p] for p in relative_image_paths(path_df)], dtype=np.int64)
+    if data_dir is None:
+        return rows
+
+    pairs = source_paths(path_df, data_dir)
+    sizes, mtimes = source_stats(pairs)
+    packed_sizes = np.load(os.path.join(directory, "sizes.npy"))
+    packed_mtimes = np.load(os.path.join(directory, "mtimes.npy"))
+    resized = (sizes != packed_sizes[rows]).any(axis=1)
+    if resized.any():
+        raise KeyError(f"{resized.sum()} image/mask pairs changed since {directory} was packed")
+
+    touched = np.flatnonzero((mtimes != packed_mtimes[rows]).any(axis=1))
+    if len(touched):
+        digests = source_digests([pairs[i] for i in touched])
+        packed_digests = np.load(os.path.join(directory, "digests.npy"))[rows[touched]]
+        changed = np.count_nonzero(digests != packed_digests)
+        if changed:
+            raise KeyError(f"{changed} image/mask pairs changed since {directory} was packed")
+        packed_mtimes[rows[touched]] = mtimes[touched]
+        tmp_path = os.path.join(directory, f"mtimes.tmp-{os.getpid()}.npy")
+        np.save(tmp_path, packed_mtimes)
+        os.replace(tmp_path, os.path.join(directory, "mtimes.npy"))
+    return rows
+
+
+class PackedMRIDataset(Dataset):
+    """Serves the pairs written by write_packed_store, as (image, mask) uint8 tensors.
+
+    The image (3, H, W) and the mask (1, H, W) are views of the memory-mapped store,
+      with no decoding nor copy: the conversion to float is left to the device, see
+      to_float_pair. Pickling the dataset only transfers its directory and rows; the
+      store is mapped again on first access.
+    """
+
+    def __init__(self, directory, rows):
+        self.directory = directory
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self._pairs = None
+
+    def __getstate__(self):
+        return self.directory, self.rows
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if self._pairs is None:
+            # Copy-on-write: the views are writable, as torch expects, without copying.
+            self._pairs = np.load(os.path.join(self.directory, "pairs.npy"), mmap_mode="c")
+        pair = torch.from_numpy(self._pairs[self.rows[idx]])
+        return pair[:3], pair[3:]
+
+
+def to_float_pair(imgs, masks):
+    """Scales a batch of uint8 PackedMRIDataset pairs to [0, 1] floats, as PairedToTensor.
+
+    Batches of float pairs are returned unchanged.
+    """
+    if imgs.dtype == torch.uint8:
+        imgs = imgs.float().div_(255)
+        masks = masks.float().div_(255)
+    return imgs, masks
+
     
-def get_train_val_datasets(download_dir, data_dir, seed, validation_ratio=0.2):
+def get_train_val_datasets(download_dir, data_dir, seed, validation_ratio=0.2, packed=False):
     
     dirs, images, masks = [], [], []
 
@@ -79,6 +252,19 @@ def get_train_val_datasets(download_dir, data_dir, seed, validation_ratio=0.2):
     
 
     
+    if packed:
+        # The pairs are decoded once, into a store shared by all the trials.
+        store_dir = os.path.join("/", download_dir.strip("/"), "packed", data_dir.strip("/"))
+        os.makedirs(os.path.dirname(store_dir), exist_ok=True)
+        with filelock.FileLock(f"{store_dir}.lock"):
+            try:
+                packed_rows(PathDF, store_dir, full_dir)
+            except (OSError, KeyError):
+                write_packed_store(PathDF, full_dir, store_dir)
+        train_data = PackedMRIDataset(store_dir, packed_rows(train_df, store_dir))
+        valid_data = PackedMRIDataset(store_dir, packed_rows(valid_df, store_dir))
+        return train_data, valid_data
+
     train_data = MRI_Dataset(train_df, full_dir, transform=PairedToTensor())
     valid_data = MRI_Dataset(valid_df, full_dir, transform=PairedToTensor())
     
@@ -89,14 +275,6 @@ def get_train_val_datasets(download_dir, data_dir, seed, validation_ratio=0.2):
 # ======================================================================================================================
 
 
-
-def safe_open_wb(path):
-    ''' Open "path" for writing, creating any parent directories as needed.
-    '''
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    return open(path, 'wb')
-
-
 def download_pach_repo(
     pachyderm_host,
     pachyderm_port,
@@ -106,43 +284,13 @@ def download_pach_repo(
     token,
     project="default",
     previous_commit=None,
+    concurrency=None,
+    incremental=False,
 ):
     print(f"Starting to download dataset: {repo}@{branch} --> {root}")
 
-    if not os.path.exists(root):
-        os.makedirs(root)
-
-    client = pachyderm_sdk.Client(
-        host=pachyderm_host, port=pachyderm_port, auth_token=token
-    )
-    files = []
-    if previous_commit is not None:
-        for diff in client.pfs.diff_file(new_file=File.from_uri(f"{project}/{repo}@{branch}"),
-            old_file=File.from_uri(f"{project}/{repo}@{previous_commit}")
-        ):
-            src_path = diff.new_file.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if diff.new_file.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-    else:
-        for file_info in client.pfs.walk_file(file=File.from_uri(f"{project}/{repo}@{branch}")):
-            src_path = file_info.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Got src='{src_path}', des='{des_path}'")
-
-            if file_info.file_type == FileType.FILE:
-                if src_path != "":
-                    files.append((src_path, des_path))
-
-    for src_path, des_path in files:
-        src_file = client.pfs.pfs_file(file=File.from_uri(f"{project}/{repo}@{branch}:{src_path}"))
-        print(f"Downloading {src_path} to {des_path}")
-
-        with safe_open_wb(des_path) as dest_file:
-            shutil.copyfileobj(src_file, dest_file)
+    downloader = PachDownloader(pachyderm_host, pachyderm_port, token, concurrency)
+    files = downloader.download_repo(project, repo, branch, root, previous_commit, incremental)
 
     print("Download operation ended")
     return files
@@ -6,12 +6,40 @@ import filelock
 import torch
 import torch.nn as nn
 from data import download_pach_repo
-from determined.pytorch import DataLoader, PyTorchTrial, PyTorchTrialContext
+from determined.pytorch import DataLoader, MetricReducer, PyTorchTrial, PyTorchTrialContext
 from torch import optim
+from unet import UNet
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
 
+class IoUReducer(MetricReducer):
+    """Reduces the IoU of all the pixels of all the batches of all slots (1 if all empty).
+
+    Updates add the intersection and union device tensors of iou(), which are only
+      copied to the host once per slot.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.intersection = 0
+        self.union = 0
+
+    def update(self, intersection, union):
+        self.intersection = self.intersection + intersection
+        self.union = self.union + union
+
+    def per_slot_reduce(self):
+        return float(self.intersection), float(self.union)
+
+    def cross_slot_reduce(self, per_slot_metrics):
+        intersection = sum(i for i, _ in per_slot_metrics)
+        union = sum(u for _, u in per_slot_metrics)
+        return intersection / union if union else 1.0
+
+
 class MRIUnetTrial(PyTorchTrial):
     def __init__(self, context: PyTorchTrialContext):
         self.context = context
@@ -35,6 +63,7 @@ class MRIUnetTrial(PyTorchTrial):
                     data_dir,
                     self.context.get_hparam("split_seed"),
                     self.context.get_hparam("validation_ratio"),
+                    self.data_config.get("packed", False),
                 )
             except:
                 pass
@@ -62,41 +91,45 @@ class MRIUnetTrial(PyTorchTrial):
                         weight_decay=self.context.get_hparam("weight_decay"),
                     )
                 )
+                self.train_iou = self.context.wrap_reducer(
+                    IoUReducer(), name="IoU", for_training=True, for_validation=False
+                )
+                self.val_iou = self.context.wrap_reducer(
+                    IoUReducer(), name="val_IoU", for_training=False, for_validation=True
+                )
             except:
                 pass
         else:
-            model = torch.hub.load(
-                self.data_config["repo"],
-                self.data_config["model"],
+            # The weights come from the checkpoint: only build the architecture, from
+            #   the copy of the hub model shipped with the experiment (no network).
+            model = UNet(
                 in_channels=self.context.get_hparam("input_channels"),
                 out_channels=self.context.get_hparam("output_channels"),
                 init_features=self.context.get_hparam("init_features"),
-                pretrained=self.context.get_hparam("pretrained"),
             )
             self.model = self.context.wrap_model(model)
 
     def iou(self, pred, label):
+        """Returns the intersection and the union of pred and label, as device tensors."""
         intersection = (pred * label).sum()
         union = pred.sum() + label.sum() - intersection
-        if pred.sum() == 0 and label.sum() == 0:
-            return 1
-        return intersection / union
+        return intersection, union
 
     def train_batch(self, batch: TorchData, epoch_idx: int, batch_idx: int):
-        imgs, masks = batch
+        imgs, masks = data.to_float_pair(*batch)
         output = self.model(imgs)
         loss = torch.nn.functional.binary_cross_entropy(output, masks)
         self.context.backward(loss)
         self.context.step_optimizer(self.optimizer)
-        iou = self.iou((output > 0.5).int(), masks)
-        return {"loss": loss, "IoU": iou}
+        self.train_iou.update(*self.iou((output > 0.5).int(), masks))
+        return {"loss": loss}
 
     def evaluate_batch(self, batch: TorchData):
-        imgs, masks = batch
+        imgs, masks = data.to_float_pair(*batch)
         output = self.model(imgs)
         loss = torch.nn.functional.binary_cross_entropy(output, masks)
-        iou = self.iou((output > 0.5).int(), masks)
-        return {"val_loss": loss, "val_IoU": iou}
+        self.val_iou.update(*self.iou((output > 0.5).int(), masks))
+        return {"val_loss": loss}
 
     def build_training_data_loader(self):
         return DataLoader(self.train_dataset, batch_size=self.context.get_per_slot_batch_size(), shuffle=True)
@@ -115,6 +148,7 @@ class MRIUnetTrial(PyTorchTrial):
             data_config["pachyderm"]["token"],
             data_config["pachyderm"]["project"],
             data_config["pachyderm"]["previous_commit"],
+            incremental=data_config["pachyderm"].get("incremental", False),
         )
         print(f"Data dir set to : {data_dir}")
         return [des for src, des in files]
@@ -0,0 +1,89 @@
+"""Measures the training throughput of the DogCatModel ResNet-50 in each mode.
+
+The modes match the `channels_last` and `amp` hyperparameters of const.yaml. On CPU,
+  mixed precision runs in bfloat16 without gradient scaling.
+
+    python benchmark.py --device cpu --batch-size 16 --steps 10
+"""
+import argparse
+import time
+
+import torch
+from torch.cuda.amp import GradScaler
+from torchvision import models
+
+from data import augment_batch
+
+# Mode name --> (channels_last, amp)
+MODES = {
+    "fp32": (False, False),
+    "channels_last": (True, False),
+    "amp": (False, True),
+    "channels_last+amp": (True, True),
+}
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark(
+    channels_last: bool,
+    amp: bool,
+    device: torch.device,
+    batch_size: int,
+    steps: int,
+    warmup: int,
+) -> float:
+    """Returns the number of images per second of a training step."""
+    torch.manual_seed(0)
+    model = models.resnet50()
+    model.fc = torch.nn.Linear(2048, 2)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    model = model.to(device).train()
+    optimizer = torch.optim.SGD(
+        model.parameters(), lr=0.005, momentum=0.9, weight_decay=1e-4, nesterov=True
+    )
+    scaler = GradScaler(enabled=amp and device.type == "cuda")
+
+    images = torch.randint(0, 256, (batch_size, 3, 240, 240), dtype=torch.uint8, device=device)
+    labels = torch.randint(0, 2, (batch_size,), device=device)
+
+    for step in range(warmup + steps):
+        if step == warmup:
+            synchronize(device)
+            start = time.perf_counter()
+        data = augment_batch(images, train=True)
+        if channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(device.type, enabled=amp):
+            loss = torch.nn.functional.cross_entropy(model(data), labels)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    synchronize(device)
+    return batch_size * steps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    baseline = None
+    for mode in args.modes:
+        throughput = benchmark(*MODES[mode], device, args.batch_size, args.steps, args.warmup)
+        baseline = baseline or throughput
+        print(f"{mode:>18}: {throughput:8.1f} images/s ({throughput / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
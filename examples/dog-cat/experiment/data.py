@@ -1,11 +1,27 @@
-from functools import lru_cache
-from typing import Optional, TypedDict, TypeVar
+import ctypes
+import fcntl
+import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import pickle
+import shutil
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypedDict, TypeVar
 
+import numpy as np
+import torch
 from pachyderm_sdk import Client
 from pachyderm_sdk.api import pfs
-from torch.utils.data import MapDataPipe, functional_datapipe
+from PIL import Image, ImageOps
+from torch.utils.data import IterDataPipe, MapDataPipe, functional_datapipe, get_worker_info
 from torch.utils.data.datapipes.utils.common import StreamWrapper
 
+from pfs_download import CLIENT_POOL, PachDownloader, split_address
+
 T_co = TypeVar('T_co', covariant=True)
 
 
@@ -14,6 +30,159 @@ class PfsData(TypedDict):
     file: StreamWrapper
 
 
+def walk_file_paginated(client: Client, file: pfs.File, page_size: int) -> Iterator[pfs.FileInfo]:
+    """Walks file with one WalkFile call per page of page_size entries."""
+    marker = None
+    while True:
+        count = 0
+        for info in client.pfs.walk_file(file=file, pagination_marker=marker, number=page_size):
+            count += 1
+            if marker is not None and info.file.path == marker.path:
+                continue
+            marker = info.file
+            yield info
+        if count < page_size:
+            return
+
+
+def resolve_commit(client: Client, commit: pfs.Commit) -> pfs.Commit:
+    """Returns commit pinned to the ID its branch (or ancestry reference) points to now."""
+    resolved = client.pfs.inspect_commit(commit=commit).commit
+    return pfs.Commit(repo=commit.repo, branch=commit.branch, id=resolved.id)
+
+
+class PfsFileIndex:
+    """Compact, array-backed index of the files of a pfs.Commit.
+
+    Paths and hashes are stored back-to-back in uint8 buffers addressed by offset
+      arrays, so the index holds a handful of NumPy arrays instead of one protobuf
+      object per file. pfs.FileInfo objects are only materialized on access.
+
+    An index saved with save() and reopened with load() is memory-mapped: forked
+      DataLoader workers share its pages, and pickling it (e.g. with the "spawn"
+      start method) only transfers the directory it was loaded from.
+    """
+
+    __slots__ = ("commit", "_paths", "_path_offsets", "_hashes", "_hash_offsets", "_sizes", "_directory")
+
+    _ARRAYS = ("_paths", "_path_offsets", "_hashes", "_hash_offsets", "_sizes")
+
+    def __init__(
+        self,
+        commit: pfs.Commit,
+        paths: np.ndarray,
+        path_offsets: np.ndarray,
+        hashes: np.ndarray,
+        hash_offsets: np.ndarray,
+        sizes: np.ndarray,
+        directory: Optional[str] = None,
+    ):
+        self.commit = commit
+        self._paths = paths
+        self._path_offsets = path_offsets
+        self._hashes = hashes
+        self._hash_offsets = hash_offsets
+        self._sizes = sizes
+        self._directory = directory
+
+    @classmethod
+    def from_file_infos(cls, commit: pfs.Commit, infos: Iterator[pfs.FileInfo]) -> "PfsFileIndex":
+        """Indexes the regular files of infos, consuming it as a stream."""
+        paths, hashes = bytearray(), bytearray()
+        path_offsets, hash_offsets, sizes = array('q', [0]), array('q', [0]), array('q')
+        for info in infos:
+            if info.file_type != pfs.FileType.FILE:
+                continue
+            paths += info.file.path.encode()
+            path_offsets.append(len(paths))
+            hashes += info.hash
+            hash_offsets.append(len(hashes))
+            sizes.append(info.size_bytes)
+
+        return cls(
+            commit,
+            np.frombuffer(paths, dtype=np.uint8),
+            np.frombuffer(path_offsets, dtype=np.int64),
+            np.frombuffer(hashes, dtype=np.uint8),
+            np.frombuffer(hash_offsets, dtype=np.int64),
+            np.frombuffer(sizes, dtype=np.int64),
+        )
+
+    @classmethod
+    def build(
+        cls,
+        client: Client,
+        root_file: pfs.File,
+        previous_root_file: Optional[pfs.File] = None,
+        page_size: int = 10_000,
+    ) -> "PfsFileIndex":
+        """Indexes all the files below root_file, or the new ones since previous_root_file.
+
+        The commits of root_file and previous_root_file should be resolved (see
+          resolve_commit): the index reads files from the commit of root_file.
+        """
+        if previous_root_file is not None:
+            diffs = client.pfs.diff_file(new_file=root_file, old_file=previous_root_file)
+            infos = (diff.new_file for diff in diffs)
+        else:
+            infos = walk_file_paginated(client, root_file, page_size)
+        return cls.from_file_infos(root_file.commit, infos)
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(os.path.join(directory, f"{name[1:]}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "commit.bin"), 'wb') as f:
+            f.write(bytes(self.commit))
+
+    @classmethod
+    def load(cls, directory: str) -> "PfsFileIndex":
+        arrays = [
+            np.load(os.path.join(directory, f"{name[1:]}.npy"), mmap_mode='r')
+            for name in cls._ARRAYS
+        ]
+        with open(os.path.join(directory, "commit.bin"), 'rb') as f:
+            commit = pfs.Commit().parse(f.read())
+        return cls(commit, *arrays, directory=directory)
+
+    def __getstate__(self):
+        if self._directory is not None:
+            return {"_directory": self._directory}
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        if set(state) == {"_directory"}:
+            state = {name: getattr(self.load(state["_directory"]), name) for name in self.__slots__}
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def size(self, idx: int) -> int:
+        return int(self._sizes[idx])
+
+    def path(self, idx: int) -> str:
+        start, end = self._path_offsets[idx], self._path_offsets[idx + 1]
+        return self._paths[start:end].tobytes().decode()
+
+    def __getitem__(self, idx: int) -> pfs.FileInfo:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return pfs.FileInfo(
+            file=pfs.File(commit=self.commit, path=self.path(idx)),
+            file_type=pfs.FileType.FILE,
+            size_bytes=int(self._sizes[idx]),
+            hash=self._hashes[self._hash_offsets[idx]:self._hash_offsets[idx + 1]].tobytes(),
+        )
+
+    def iter_file_infos(self, start: int = 0, stop: Optional[int] = None) -> Iterator[pfs.FileInfo]:
+        for idx in range(*slice(start, stop).indices(len(self))):
+            yield self[idx]
+
+
 class PfsFileDataPipe(MapDataPipe[PfsData]):
     """MapDataPipe implementation for accessing files stored in PFS.
 
@@ -22,6 +191,17 @@ class PfsFileDataPipe(MapDataPipe[PfsData]):
 
     If a previous_commit is specified, then this class accesses all _new_
       files added between previous_commit and commit.
+
+    Files can also be prefetched in bulk to a local directory with prefetch(), in
+      which case __getitem__ serves the local copies.
+
+    commit and previous_commit are resolved to commit IDs once, so every file is
+      read from the commit that was indexed even if the branch moves meanwhile.
+
+    The file index is a PfsFileIndex. If index_dir is specified, it is loaded from
+      the subdirectory of the resolved commit (and previous commit) when it exists,
+      otherwise built, saved there and memory-mapped back, which lets DataLoader
+      workers (and other ranks on the node) share it.
     """
 
     def __init__(
@@ -29,34 +209,38 @@ class PfsFileDataPipe(MapDataPipe[PfsData]):
         client: Client,
         commit: pfs.Commit,
         path="/",
-        previous_commit: Optional[pfs.Commit] = None
+        previous_commit: Optional[pfs.Commit] = None,
+        index_dir: Optional[str] = None,
+        page_size: int = 10_000,
     ):
-        self.client = client
+        self.pachd = (*split_address(client), client.auth_token)
+        commit = resolve_commit(client, commit)
+        if previous_commit is not None:
+            previous_commit = resolve_commit(client, previous_commit)
         self.root_file = pfs.File(commit=commit, path=path)
         self.previous_commit = previous_commit
-
-        # Collect a list of all files that will be "piped".
-        # Notes:
-        #   * This may cause memory issues when indexing >1,000,000 files.
-        #   * The memory efficiency of this could be improved by only storing the
-        #     URI string of the file, at the cost of requiring an additional
-        #     InspectFile call to re-retrieve the FileInfo object at time of access.
-        #   * We could take this to the extreme and use pagination to have make the
-        #     memory footprint negligible, at the cost of (on average) many network
-        #     calls at time of access and making the implementation of this class
-        #     significantly more complicated.
-        self._file_infos = []
+        # Identifies the files served, to key what is derived from them.
+        self.version = commit.id
         if previous_commit is not None:
-            previous_root_file = pfs.File(commit=self.previous_commit, path=path)
-            for diff in client.pfs.diff_file(
-                    new_file=self.root_file, old_file=previous_root_file
-            ):
-                if diff.new_file.file_type == pfs.FileType.FILE:
-                    self._file_infos.append(diff.new_file)
+            self.version += f"-since-{previous_commit.id}"
+        self.local_root: Optional[str] = None
+
+        # Index all files that will be "piped". The index stores paths, sizes and
+        #   hashes in flat arrays (a few dozen bytes per file), which keeps its
+        #   memory footprint reasonable beyond 1,000,000 files. walk_file is
+        #   paginated; diff_file does not support pagination.
+        if index_dir is not None:
+            index_dir = os.path.join(index_dir, self.version)
+        if index_dir is not None and os.path.exists(os.path.join(index_dir, "commit.bin")):
+            self._index = PfsFileIndex.load(index_dir)
         else:
-            for info in client.pfs.walk_file(file=self.root_file):
-                if info.file_type == pfs.FileType.FILE:
-                    self._file_infos.append(info)
+            previous_root_file = None
+            if previous_commit is not None:
+                previous_root_file = pfs.File(commit=self.previous_commit, path=path)
+            self._index = PfsFileIndex.build(client, self.root_file, previous_root_file, page_size)
+            if index_dir is not None:
+                self._index.save(index_dir)
+                self._index = PfsFileIndex.load(index_dir)
 
         # If this DataPipe is loaded using a DataLoader with `num_workers` > 0, then
         #   the __getitem__ calls will occur within a multiprocessing worker. This is
@@ -66,38 +250,717 @@ class PfsFileDataPipe(MapDataPipe[PfsData]):
         #        - GRPC_ENABLE_FORK_SUPPORT=true
         #        - GRPC_POLL_STRATEGY=poll
         #   2. The client must be recreated within the worker process, since gRPC will
-        #      close the grpc.Channel when `fork()` is called.
+        #      close the grpc.Channel when `fork()` is called. CLIENT_POOL takes care
+        #      of it: it drops its channels in forked children.
         #      ref: github.com/grpc/grpc/blob/master/doc/fork_support.md
-        self.worker_client: Optional[Client] = None
+        # Only the address of pachd is kept, which also keeps this DataPipe picklable.
+
+    def connect(self) -> Client:
+        """Returns the pooled client of the current process."""
+        return CLIENT_POOL.get(*self.pachd)
 
     def __getitem__(self, idx) -> PfsData:
-        if self.worker_client is None:
-            self.worker_client = Client.from_pachd_address(
-                pachd_address=self.client.address,
-                auth_token=self.client.auth_token,
-            )
+        info = self._index[idx]
+        if self.local_root is not None:
+            local_path = os.path.join(self.local_root, info.file.path[1:])
+            if os.path.exists(local_path):
+                return PfsData(info=info, file=StreamWrapper(open(local_path, 'rb')))
 
-        info = self._file_infos[idx]
-        file = self.worker_client.pfs.pfs_file(file=info.file)
+        file = self.connect().pfs.pfs_file(file=info.file)
         return PfsData(info=info, file=StreamWrapper(file))
 
     def __len__(self):
-        return len(self._file_infos)
+        return len(self._index)
+
+    def size(self, idx: int) -> int:
+        """Returns the size in bytes of the file idx, without materializing its FileInfo."""
+        return self._index.size(idx)
+
+    def path(self, idx: int) -> str:
+        """Returns the PFS path of the file idx, without materializing its FileInfo."""
+        return self._index.path(idx)
+
+    def prefetch(
+        self,
+        root: str,
+        start: int = 0,
+        stop: Optional[int] = None,
+        num_shards: Optional[int] = None,
+    ) -> None:
+        """Downloads the files [start, stop) of the index below root.
+
+        The files are fetched as a few TAR streams (one per shard of the index)
+          rather than with one GetFile call each. This must be called before the
+          DataLoader workers are forked.
+        """
+        downloader = PachDownloader(*self.pachd)
+        downloader.download_shards(self._index.iter_file_infos(start, stop), root, num_shards)
+        self.local_root = root
+
+    def sync(self, base: str) -> None:
+        """Syncs the node-local mirror of the branch kept in base, then serves a snapshot.
+
+        Only the files that changed since the commit last synced in base are
+          transferred, and the snapshot served does not change while this process
+          runs (see PachDownloader.sync_snapshot). This must be called before the
+          DataLoader workers are forked.
+        """
+        commit = self.root_file.commit
+        downloader = PachDownloader(*self.pachd)
+        self.local_root, _ = downloader.sync_snapshot(
+            commit.branch.repo.project.name,
+            commit.branch.repo.name,
+            commit.id or commit.branch.name,
+            base,
+        )
+
+
+class PfsPrefetchDataPipe(IterDataPipe[PfsData]):
+    """Iterates over the files of a PfsFileDataPipe, reading ahead on a thread pool.
+
+    Files are visited in the order of indices (e.g. a Sampler, iterated again at
+      every epoch; all files in index order by default) and yielded in that order,
+      fully read in memory. Up to `window` files are in flight at any time, and when
+      max_bytes is specified, no file is requested while the files already in flight
+      (but not yet yielded) total more than max_bytes.
+
+    The threads share the pooled client of the process iterating this DataPipe, so
+      the fork rules of PfsFileDataPipe still apply. Within DataLoader workers, each
+      worker handles a disjoint 1/N of the indices: shuffle them with EpochShuffle,
+      whose order is the same in all the workers.
+    """
+
+    def __init__(
+        self,
+        source: PfsFileDataPipe,
+        indices: Optional[Iterable[int]] = None,
+        window: int = 16,
+        max_bytes: Optional[int] = None,
+        num_threads: int = 4,
+    ):
+        self._source = source
+        self._indices = indices
+        self.window = window
+        self.max_bytes = max_bytes
+        self.num_threads = num_threads
+
+    def _fetch(self, idx: int) -> PfsData:
+        item = self._source[idx]
+        try:
+            content = item['file'].read()
+        finally:
+            item['file'].close()
+        return PfsData(info=item['info'], file=StreamWrapper(io.BytesIO(content)))
+
+    def __iter__(self) -> Iterator[PfsData]:
+        indices = self._indices if self._indices is not None else range(len(self._source))
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            indices = (
+                idx for i, idx in enumerate(indices)
+                if i % worker_info.num_workers == worker_info.id
+            )
+
+        # Create the client of this process before the threads race to do it.
+        self._source.connect()
+
+        pending = deque()
+        pending_bytes = 0
+        pool = ThreadPoolExecutor(self.num_threads, thread_name_prefix="pfs-prefetch")
+        try:
+            for idx in indices:
+                size = self._source.size(idx)
+                while pending and (
+                    len(pending) >= self.window
+                    or (self.max_bytes is not None and pending_bytes + size > self.max_bytes)
+                ):
+                    future, nbytes = pending.popleft()
+                    pending_bytes -= nbytes
+                    yield future.result()
+                pending.append((pool.submit(self._fetch, idx), size))
+                pending_bytes += size
+
+            while pending:
+                future, _ = pending.popleft()
+                yield future.result()
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self):
+        if self._indices is not None:
+            return len(self._indices)
+        return len(self._source)
+
+
+class EpochShuffle:
+    """Iterable over a new permutation of indices at every iteration.
+
+    The permutation only depends on seed, the number of previous iterations and the
+      base seed of the DataLoader iterator, so the DataLoader workers iterating their
+      own copy (persistent or not) agree on the order and can split it.
+    """
+
+    def __init__(self, indices: Sequence[int], seed: int = 0):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self) -> Iterator[int]:
+        worker_info = get_worker_info()
+        # Worker seeds are the base seed of the iterator plus the worker id.
+        base_seed = worker_info.seed - worker_info.id if worker_info is not None else 0
+        rng = np.random.default_rng((self.seed, base_seed, self.epoch))
+        self.epoch += 1
+        return iter(self.indices[rng.permutation(len(self.indices))].tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class ByteLRUCache:
+    """LRU cache of pickled items bounded in bytes, with an optional disk tier.
+
+    Items evicted from memory are spilled to spill_dir (bounded by max_disk_bytes)
+      and promoted back to memory on their next hit. Hit, miss, spill and eviction
+      counters are available through stats().
+
+    The limits are shared by the num_workers DataLoader worker processes using the
+      cache (the main process alone when 0): every process gets its own memory and
+      disk tiers of 1/num_workers of the limits, spilling to a subdirectory of
+      spill_dir named after its pid. The counters of all the processes are kept in
+      shared memory, so stats() in the main process covers the workers.
+    """
+
+    STATS = ("hits", "disk_hits", "misses", "spills", "evictions", "memory_bytes", "disk_bytes")
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        max_items: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        max_disk_bytes: Optional[int] = None,
+        num_workers: int = 0,
+    ):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.num_workers = num_workers
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        # One row per process slot: its pid, then its STATS. Row 0 accumulates the
+        #   counters of the processes that exited.
+        self._slots = multiprocessing.Array(ctypes.c_int64, (num_workers + 2) * (len(self.STATS) + 1))
+        self._pid = None
+
+    @property
+    def _counters(self) -> np.ndarray:
+        return np.frombuffer(self._slots.get_obj(), dtype=np.int64).reshape(-1, len(self.STATS) + 1)
+
+    def _bind(self) -> None:
+        # DataLoader workers start with a copy of the cache of the main process: the
+        #   first use in a process gives it its own share of the limits, spill
+        #   directory and counters.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        share = max(1, self.num_workers)
+        self._max_bytes = None if self.max_bytes is None else self.max_bytes // share
+        self._max_items = None if self.max_items is None else max(1, self.max_items // share)
+        self._max_disk_bytes = None if self.max_disk_bytes is None else self.max_disk_bytes // share
+
+        self._memory: "OrderedDict[int, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[int, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._row = self._claim_slot()
+        if self.spill_dir is not None:
+            # A previous process with the same pid may have left files behind.
+            shutil.rmtree(self._process_dir(self._pid), ignore_errors=True)
+            os.makedirs(self._process_dir(self._pid))
+
+    def _claim_slot(self) -> np.ndarray:
+        counters = self._counters
+        with self._slots.get_lock():
+            for row in counters[1:]:
+                pid = int(row[0])
+                if pid != 0 and _is_alive(pid):
+                    continue
+                if pid != 0:
+                    # Keep the counters of the exited process, but not its files.
+                    counters[0, 1:6] += row[1:6]
+                    if self.spill_dir is not None:
+                        shutil.rmtree(self._process_dir(pid), ignore_errors=True)
+                row[:] = 0
+                row[0] = self._pid
+                return row
+        # More processes than expected: the counters of this one are not reported.
+        return np.zeros(len(self.STATS) + 1, dtype=np.int64)
+
+    def _count(self, name: str, n: int = 1) -> None:
+        self._row[1 + self.STATS.index(name)] += n
+
+    def stats(self) -> Dict[str, int]:
+        counters = self._counters.copy()
+        for row in counters[1:]:
+            # Memory and disk usage are only reported for the running processes.
+            if row[0] != 0 and not _is_alive(int(row[0])):
+                row[6:] = 0
+        totals = counters[:, 1:].sum(axis=0)
+        return {name: int(total) for name, total in zip(self.STATS, totals)}
+
+    def get(self, key: int) -> Optional[bytes]:
+        self._bind()
+        blob = self._memory.get(key)
+        if blob is not None:
+            self._memory.move_to_end(key)
+            self._count("hits")
+            return blob
+
+        if key in self._disk:
+            size = self._disk.pop(key)
+            self._disk_bytes -= size
+            self._count("disk_bytes", -size)
+            try:
+                with open(self._spill_path(key), 'rb') as f:
+                    blob = f.read()
+                os.remove(self._spill_path(key))
+            except FileNotFoundError:
+                blob = None
+            if blob is not None:
+                self._count("disk_hits")
+                self.put(key, blob)
+                return blob
+
+        self._count("misses")
+        return None
+
+    def put(self, key: int, blob: bytes) -> None:
+        self._bind()
+        if self._max_bytes is not None and len(blob) > self._max_bytes:
+            return
+        self._memory[key] = blob
+        self._memory_bytes += len(blob)
+        self._count("memory_bytes", len(blob))
+        while (
+            (self._max_bytes is not None and self._memory_bytes > self._max_bytes)
+            or (self._max_items is not None and len(self._memory) > self._max_items)
+        ):
+            old_key, old_blob = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_blob)
+            self._count("memory_bytes", -len(old_blob))
+            self._spill(old_key, old_blob)
+
+    def _process_dir(self, pid: int) -> str:
+        return os.path.join(self.spill_dir, str(pid))
+
+    def _spill_path(self, key: int) -> str:
+        return os.path.join(self._process_dir(self._pid), str(key))
+
+    def _spill(self, key: int, blob: bytes) -> None:
+        if self.spill_dir is None:
+            self._count("evictions")
+            return
+        tmp_path = f"{self._spill_path(key)}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, self._spill_path(key))
+        self._disk[key] = len(blob)
+        self._disk_bytes += len(blob)
+        self._count("disk_bytes", len(blob))
+        self._count("spills")
+
+        while self._max_disk_bytes is not None and self._disk_bytes > self._max_disk_bytes:
+            old_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._count("disk_bytes", -size)
+            self._count("evictions")
+            try:
+                os.remove(self._spill_path(old_key))
+            except FileNotFoundError:
+                pass
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedArenaCache:
+    """Cache of pickled items in a memory-mapped arena shared by a node's processes.
+
+    The arena is a single file (put it on /dev/shm to keep it in memory) made of a
+      header, a table of (offset, length) per key and a data region filled by a bump
+      allocator. All DataLoader workers and ranks of a node that open the same path
+      share the cached items, so each item is fetched once per node: the path must
+      therefore identify the content cached (e.g. the commit indexed).
+
+    Lookups are lock-free; insertions take an exclusive flock on path + ".lock". Items
+      are never evicted: once the data region is full, new items are not cached.
+
+    An arena in use is never truncated: an arena of another layout is replaced by a
+      new file, and the other arenas of the directory of path that no process holds
+      (each process keeps a shared flock on its arena) are removed. The hit, miss and
+      dropped counters are kept in the header, for all the processes; increments
+      are not atomic, so they are approximate.
+    """
+
+    MAGIC = 0x5044_4b5f_4341_4348
+    # magic, capacity, allocated bytes, number of keys, hits, misses, dropped (int64 each)
+    HEADER_SIZE = 56
+
+    def __init__(self, path: str, num_keys: int, max_bytes: int):
+        self.path = path
+        self.num_keys = num_keys
+        self.max_bytes = max_bytes
+
+        self._data_offset = self.HEADER_SIZE + 16 * num_keys
+        size = self._data_offset + max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock():
+            fd = self._open(path, size)
+            if fd is None:
+                fd = self._create(size)
+            # fd holds a shared flock until the process exits, so that the arena is
+            #   not pruned while in use.
+            self._fd = fd
+            self._mmap = mmap.mmap(fd, size)
+            self._header = np.ndarray((7,), dtype=np.int64, buffer=self._mmap)
+            self._table = np.ndarray(
+                (num_keys, 2), dtype=np.int64, buffer=self._mmap, offset=self.HEADER_SIZE
+            )
+        self._prune()
+
+    def _open(self, path: str, size: int) -> Optional[int]:
+        """Opens the arena at path if it has the layout of this cache."""
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        header = np.frombuffer(os.pread(fd, 32, 0).ljust(32, b"\0"), dtype=np.int64)
+        if (
+            os.fstat(fd).st_size == size
+            and header[0] == self.MAGIC
+            and header[1] == self.max_bytes
+            and header[3] == self.num_keys
+        ):
+            return fd
+        os.close(fd)
+        return None
+
+    def _create(self, size: int) -> int:
+        """Creates a new, empty arena at path, without touching the one it replaces."""
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            # Reserve the whole arena now: writing to pages of a sparse file that
+            #   /dev/shm cannot back raises SIGBUS instead of an error.
+            os.posix_fallocate(fd, 0, size)
+            header = np.array(
+                (self.MAGIC, self.max_bytes, 0, self.num_keys, 0, 0, 0), dtype=np.int64
+            )
+            os.pwrite(fd, header.tobytes(), 0)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise OSError(
+                e.errno, f"Cannot allocate a cache arena of {size} bytes at {self.path}"
+            ) from e
+        return fd
+
+    def _prune(self) -> None:
+        directory = os.path.dirname(self.path) or "."
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if path == self.path or name.endswith(".lock"):
+                continue
+            if ".tmp-" in name:
+                # Left by a process that died while creating an arena.
+                pid = name.rsplit(".tmp-", 1)[1]
+                if pid.isdigit() and not _is_alive(int(pid)):
+                    os.remove(path)
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            else:
+                # Mappings of the removed file stay valid until they are closed.
+                os.remove(path)
+                try:
+                    os.remove(path + ".lock")
+                except FileNotFoundError:
+                    pass
+                print(f"Removed the unused cache arena {path}")
+            finally:
+                os.close(fd)
+
+    def _lock(self):
+        # flock locks are shared between forked processes holding the same open file
+        #   description, so the lock file is re-opened for every critical section.
+        lock_file = open(self.path + ".lock", 'a+')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def __getstate__(self):
+        return {"path": self.path, "num_keys": self.num_keys, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": int(self._header[4]),
+            "misses": int(self._header[5]),
+            "dropped": int(self._header[6]),
+            "shared_bytes": int(self._header[2]),
+        }
+
+    def get(self, key: int) -> Optional[bytes]:
+        # The length is read before the offset, which put() publishes first.
+        length = self._table[key, 1]
+        if length == 0:
+            self._header[5] += 1
+            return None
+        offset = self._table[key, 0]
+        self._header[4] += 1
+        start = self._data_offset + int(offset)
+        return self._mmap[start:start + int(length)]
+
+    def put(self, key: int, blob: bytes) -> None:
+        with self._lock():
+            if self._table[key, 1] != 0:
+                return
+            offset = int(self._header[2])
+            if offset + len(blob) > self.max_bytes:
+                self._header[6] += 1
+                return
+            start = self._data_offset + offset
+            self._mmap[start:start + len(blob)] = blob
+            self._header[2] = offset + len(blob)
+            # The length is published last: a non-zero length marks a complete item.
+            self._table[key, 0] = offset
+            self._table[key, 1] = len(blob)
 
 
 @functional_datapipe(name="with_cache")
 class CacheDataPipe(MapDataPipe[T_co]):
+    """Caches the items of source, keyed by index.
 
-    def __init__(self, source: MapDataPipe[T_co], cache_size: Optional[int] = None):
-        self._source = source
+    With backend="local" (default), items are stored in a ByteLRUCache whose limits
+      are split across the num_workers DataLoader workers expected to read this
+      DataPipe. With backend="shared", items are stored in a SharedArenaCache of
+      max_bytes at shared_path, read by all the processes of the node.
 
-        @lru_cache(cache_size)
-        def __cached_getitem__(idx):
-            return source[idx]
-        self.__cached_getitem__ = __cached_getitem__
+    Items are stored pickled, so the budget is accounted in bytes and the cached
+      items must be picklable: cache raw bytes or decoded arrays rather than open
+      files or PIL images. With no limits, the local cache is unbounded.
+    """
+
+    def __init__(
+        self,
+        source: MapDataPipe[T_co],
+        cache_size: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        max_disk_bytes: Optional[int] = None,
+        backend: str = "local",
+        shared_path: Optional[str] = None,
+        num_workers: int = 0,
+    ):
+        self._source = source
+        if backend == "local":
+            self.cache = ByteLRUCache(max_bytes, cache_size, spill_dir, max_disk_bytes, num_workers)
+        elif backend == "shared":
+            if shared_path is None or max_bytes is None:
+                raise ValueError("The shared cache backend requires shared_path and max_bytes")
+            self.cache = SharedArenaCache(shared_path, len(source), max_bytes)
+        else:
+            raise ValueError(f"Unknown cache backend: {backend}")
 
     def __getitem__(self, idx) -> T_co:
-        return self.__cached_getitem__(idx)
+        blob = self.cache.get(idx)
+        if blob is not None:
+            return pickle.loads(blob)
+        item = self._source[idx]
+        self.cache.put(idx, pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL))
+        return item
 
     def __len__(self):
         return len(self._source)
+
+    def stats(self) -> Dict[str, int]:
+        return self.cache.stats()
+
+
+def hash_split(paths: Iterable[str], validation_ratio: float) -> Tuple[List[int], List[int]]:
+    """Splits the indices of paths into (train, validation) by a stable hash of each path.
+
+    A file lands in the same split on every rank and after every restart, whatever
+      the order of the listing, and stays there when files are added or removed.
+    """
+    threshold = int(validation_ratio * 2**64)
+    train, validation = [], []
+    for idx, path in enumerate(paths):
+        digest = hashlib.blake2b(path.encode(), digest_size=8).digest()
+        (validation if int.from_bytes(digest, "little") < threshold else train).append(idx)
+    return train, validation
+
+
+def decode_image(blob: bytes, size: int) -> np.ndarray:
+    """Decodes an image into a (size, size, 3) uint8 array.
+
+    The short side is resized to size and the long side center-cropped. JPEG
+      images are decoded at the smallest DCT scale that is still large enough.
+    """
+    image = Image.open(io.BytesIO(blob))
+    image.draft("RGB", (size, size))
+    image = ImageOps.fit(image.convert("RGB"), (size, size), Image.BILINEAR)
+    return np.asarray(image)
+
+
+def write_image_shards(
+    source: MapDataPipe[Tuple[bytes, int]],
+    directory: str,
+    size: int = 240,
+    shard_size: int = 4096,
+    num_threads: int = 8,
+) -> None:
+    """Decodes the (image bytes, label) items of source into the format of ImageShardDataPipe.
+
+    Item i of source is written to row i % shard_size of shard-{i // shard_size}.npy,
+      a (shard_size, size, size, 3) uint8 array. Items that cannot be decoded are
+      skipped: index.npy lists the source indices of the items written and labels.npy
+      their labels. The shards are written to a temporary directory, renamed to
+      directory once complete.
+    """
+    def load(idx):
+        blob, label = source[idx]
+        try:
+            return decode_image(blob, size), label
+        except (OSError, ValueError) as err:
+            print(f"Skipping item {idx}: {err}")
+            return None, label
+
+    tmp_dir = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    sources, labels = [], []
+    with ThreadPoolExecutor(num_threads, thread_name_prefix="decode") as pool:
+        for start in range(0, len(source), shard_size):
+            indices = range(start, min(start + shard_size, len(source)))
+            shard = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, f"shard-{start // shard_size:05d}.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(len(indices), size, size, 3),
+            )
+            for idx, (image, label) in zip(indices, pool.map(load, indices)):
+                if image is not None:
+                    shard[idx - start] = image
+                    sources.append(idx)
+                    labels.append(label)
+            shard.flush()
+            del shard
+            print(f"Decoded {indices.stop}/{len(source)} images to {tmp_dir}")
+
+    np.save(os.path.join(tmp_dir, "labels.npy"), np.array(labels, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "index.npy"), np.array(sources, dtype=np.int64))
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Written by another process in the meantime.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def open_image_shards(source: MapDataPipe[Tuple[bytes, int]], directory: str) -> "ImageShardDataPipe":
+    """Returns the ImageShardDataPipe of directory, written from source if it does not exist.
+
+    directory must identify the content of source (e.g. its commit). Concurrent
+      callers (e.g. the ranks of a node) wait for the first one to write the shards.
+    """
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    with open(f"{directory}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(directory):
+            write_image_shards(source, directory)
+    return ImageShardDataPipe(directory)
+
+
+class ImageShardDataPipe(MapDataPipe[Tuple[np.ndarray, int]]):
+    """Serves the (image, label) items written by write_image_shards.
+
+    Images are (size, size, 3) uint8 arrays copied out of memory-mapped shards, so
+      no image is decoded nor resized while training. Pickling the DataPipe only
+      transfers its directory; shards are mapped again on first access.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._sources = np.load(os.path.join(directory, "index.npy"))
+        self._labels = np.load(os.path.join(directory, "labels.npy"))
+        self._shards = None
+
+    def __getstate__(self):
+        return self.directory
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def _load_shards(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith("shard-"))
+        self._shards = [np.load(os.path.join(self.directory, n), mmap_mode="r") for n in names]
+
+    def source(self, idx: int) -> int:
+        """Returns the index in the source DataPipe of the item idx."""
+        return int(self._sources[idx])
+
+    def __getitem__(self, idx) -> Tuple[np.ndarray, int]:
+        if self._shards is None:
+            self._load_shards()
+        shard_idx, row = divmod(int(self._sources[idx]), len(self._shards[0]))
+        return np.array(self._shards[shard_idx][row]), int(self._labels[idx])
+
+    def __len__(self):
+        return len(self._sources)
+
+
+def augment_batch(images: torch.Tensor, crop_size: int = 224, train: bool = True) -> torch.Tensor:
+    """Crops, flips and normalizes a (B, C, H, W) uint8 batch, on the device of images.
+
+    In training, every image gets its own random crop offset and horizontal flip,
+      drawn as (B,) tensors and applied with a single gather; otherwise images are
+      center-cropped. Returns (B, C, crop_size, crop_size) floats in [-1, 1], i.e.
+      Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)) applied to ToTensor's output.
+    """
+    b, c, h, w = images.shape
+    if train:
+        device = images.device
+        steps = torch.arange(crop_size, device=device)
+        top = torch.randint(0, h - crop_size + 1, (b, 1), device=device)
+        left = torch.randint(0, w - crop_size + 1, (b, 1), device=device)
+        flip = torch.rand(b, 1, device=device) < 0.5
+        rows = top + steps
+        cols = left + torch.where(flip, crop_size - 1 - steps, steps)
+        images = images[
+            torch.arange(b, device=device)[:, None, None, None],
+            torch.arange(c, device=device)[None, :, None, None],
+            rows[:, None, :, None],
+            cols[:, None, None, :],
+        ]
+    else:
+        top, left = (h - crop_size) // 2, (w - crop_size) // 2
+        images = images[:, :, top:top + crop_size, left:left + crop_size]
+    return images.float().div_(127.5).sub_(1.0)
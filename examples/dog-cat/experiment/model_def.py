@@ -1,20 +1,35 @@
+import io
 import logging
 import os
+
+# gRPC reads these when it is first imported. They are required to use the pachd
+#   client from forked DataLoader workers (see PfsFileDataPipe).
+os.environ.setdefault("GRPC_ENABLE_FORK_SUPPORT", "true")
+os.environ.setdefault("GRPC_POLL_STRATEGY", "poll")
+
 from typing import Any, Callable, Dict, List, Sequence, Tuple, Union, cast
 
 import numpy as np
-import pachyderm_sdk
 import torch
 from pachyderm_sdk.api import pfs
 from determined import InvalidHP
-from determined.pytorch import DataLoader, PyTorchTrial
+from determined.pytorch import DataLoader, MetricReducer, PyTorchTrial
 from PIL import Image
 from torch import Tensor
-from torch.utils.data import random_split, Dataset
+from torch.cuda.amp import GradScaler
+from torch.utils.data import Dataset, Subset
 from torch.utils.data.datapipes.map import Mapper
 from torchvision import models, transforms
 
-from data import PfsFileDataPipe
+from data import (
+    EpochShuffle,
+    PfsFileDataPipe,
+    PfsPrefetchDataPipe,
+    augment_batch,
+    hash_split,
+    open_image_shards,
+)
+from pfs_download import MIRROR_DIR, get_client
 
 DogCatItem = Tuple['Image.Image', int]
 TorchData = Union[Dict[str, Tensor], Sequence[Tensor], Tensor]
@@ -26,6 +41,39 @@ logging.getLogger().setLevel(logging.INFO)
 # =============================================================================
 
 
+class RatioReducer(MetricReducer):
+    """Reduces sum(numerators) / sum(denominators) over all the batches of all slots.
+
+    Updates add device tensors without synchronizing with the device; the sums are
+      only copied to the host once per slot, when the metric is reduced. The ratio
+      is therefore exact with a ragged last batch. `empty` is returned when the
+      denominator is 0.
+    """
+
+    def __init__(self, empty: float = 0.0):
+        self.empty = empty
+        self.reset()
+
+    def reset(self):
+        self.numerator = 0
+        self.denominator = 0
+
+    def update(self, numerator, denominator):
+        self.numerator = self.numerator + numerator
+        self.denominator = self.denominator + denominator
+
+    def per_slot_reduce(self):
+        return float(self.numerator), float(self.denominator)
+
+    def cross_slot_reduce(self, per_slot_metrics):
+        numerator = sum(n for n, _ in per_slot_metrics)
+        denominator = sum(d for _, d in per_slot_metrics)
+        return numerator / denominator if denominator else self.empty
+
+
+# =============================================================================
+
+
 class DogCatModel(PyTorchTrial):
     def __init__(self, context):
         self.context = context
@@ -42,8 +90,22 @@ class DogCatModel(PyTorchTrial):
                 print("No data. Aborting training.")
                 raise InvalidHP("No data")
 
+        # Opt-in channels_last layout and mixed precision (see benchmark.py).
+        self.channels_last = bool(self.context.get_hparams().get("channels_last", False))
+        self.amp = bool(self.context.get_hparams().get("amp", False))
+
         model = models.resnet50(pretrained=load_weights)
         model.fc = torch.nn.Linear(2048, 2)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = self.context.wrap_model(model)
+        self.labels = ["dog", "cat"]
+        self.predict_transform = None
+
+        # In serving mode, only the architecture is needed to load the checkpoint.
+        if not load_weights:
+            return
+
         optimizer = torch.optim.SGD(
             model.parameters(),
             lr=float(self.context.get_hparam("learning_rate")),
@@ -51,10 +113,21 @@ class DogCatModel(PyTorchTrial):
             weight_decay=float(self.context.get_hparam("weight_decay")),
             nesterov=self.context.get_hparam("nesterov"),
         )
-
-        self.model = self.context.wrap_model(model)
         self.optimizer = self.context.wrap_optimizer(optimizer)
-        self.labels = ["dog", "cat"]
+        self.scaler = None
+        if self.amp and torch.cuda.is_available():
+            self.scaler = self.context.wrap_scaler(GradScaler())
+        self.accuracy = self.context.wrap_reducer(
+            RatioReducer(), name="accuracy", for_training=False, for_validation=True
+        )
+
+    # -------------------------------------------------------------------------
+
+    def prepare(self, data: Tensor, train: bool) -> Tensor:
+        data = augment_batch(data, train=train)
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        return data
 
     # -------------------------------------------------------------------------
 
@@ -63,12 +136,19 @@ class DogCatModel(PyTorchTrial):
     ) -> Union[Tensor, Dict[str, Any]]:
         batch = cast(Tuple[Tensor, Tensor], batch)
         data, labels = batch
+        data = self.prepare(data, train=True)
 
-        output = self.model(data)
-        loss = torch.nn.functional.cross_entropy(output, labels)
+        with torch.autocast(data.device.type, enabled=self.amp):
+            output = self.model(data)
+            loss = torch.nn.functional.cross_entropy(output, labels)
 
-        self.context.backward(loss)
-        self.context.step_optimizer(self.optimizer)
+        if self.scaler is not None:
+            self.context.backward(self.scaler.scale(loss))
+            self.context.step_optimizer(self.optimizer, scaler=self.scaler)
+            self.scaler.update()
+        else:
+            self.context.backward(loss)
+            self.context.step_optimizer(self.optimizer)
 
         return {"loss": loss}
 
@@ -81,26 +161,51 @@ class DogCatModel(PyTorchTrial):
         Calculate validation metrics for a batch and return them as a dictionary.
         This method is not necessary if the user overwrites evaluate_full_dataset().
         """
+        if batch_idx == 0 and self.cache is not None:
+            logging.info(f"Dataset cache stats: {self.cache.stats()}")
+
         batch = cast(Tuple[Tensor, Tensor], batch)
         data, labels = batch
-        output = self.model(data)
+        data = self.prepare(data, train=False)
+        with torch.autocast(data.device.type, enabled=self.amp):
+            output = self.model(data)
+            loss = torch.nn.functional.cross_entropy(output, labels)
 
-        pred = output.argmax(dim=1, keepdim=True)
-        accuracy = pred.eq(labels.view_as(pred)).sum().item() / len(data)
-        return {"accuracy": accuracy}
+        pred = output.argmax(dim=1)
+        self.accuracy.update(pred.eq(labels).sum(), len(labels))
+        return {"validation_loss": loss}
+
+    # -------------------------------------------------------------------------
+
+    def data_loader_options(self) -> Dict[str, Any]:
+        hparams = self.context.get_hparams()
+        num_workers = int(hparams.get("num_workers", 0))
+        options = {
+            "num_workers": num_workers,
+            "pin_memory": bool(hparams.get("pin_memory", torch.cuda.is_available())),
+        }
+        # Both options are rejected by DataLoader without workers.
+        if num_workers > 0:
+            options["persistent_workers"] = bool(hparams.get("persistent_workers", True))
+            options["prefetch_factor"] = int(hparams.get("prefetch_factor", 2))
+        return options
 
     # -------------------------------------------------------------------------
 
     def build_training_data_loader(self) -> DataLoader:
         return DataLoader(
-            self.train_ds, batch_size=self.context.get_per_slot_batch_size()
+            self.train_ds,
+            batch_size=self.context.get_per_slot_batch_size(),
+            **self.data_loader_options(),
         )
 
     # -------------------------------------------------------------------------
 
     def build_validation_data_loader(self) -> DataLoader:
         return DataLoader(
-            self.val_ds, batch_size=self.context.get_per_slot_batch_size()
+            self.val_ds,
+            batch_size=self.context.get_per_slot_batch_size(),
+            **self.data_loader_options(),
         )
 
     # -------------------------------------------------------------------------
@@ -108,64 +213,126 @@ class DogCatModel(PyTorchTrial):
     def create_datasets(self) -> Tuple[Dataset, Dataset]:
         data_config = self.context.get_data_config()
         pach_config = data_config["pachyderm"]
-        client = pachyderm_sdk.Client(
-            host=pach_config["host"],
-            port=pach_config["port"],
-            auth_token=pach_config["token"],
+        client = get_client(
+            pach_config["host"], pach_config["port"], pach_config["token"]
         )
         project = pach_config['project'] or 'default'
         repo, branch = pach_config['repo'], pach_config['branch']
         commit = pfs.Commit.from_uri(f"{project}/{repo}@{branch}")
+        # In incremental mode, the whole commit is indexed and a node-local copy of the
+        #   repository is synced with it, which transfers only the files that changed.
+        incremental = pach_config.get('incremental')
         previous_commit = None
-        if pach_config['previous_commit']:
+        if pach_config['previous_commit'] and not incremental:
             previous_commit = pfs.Commit.from_uri(f"{project}/{repo}@{pach_config['previous_commit']}")
 
-        # Create the DataPipe and convert the output to (Image, Label).
-        datapipe = PfsFileDataPipe(client, commit, previous_commit=previous_commit).map(
-            lambda item: (Image.open(item['file']), 0 if "dog" in item['info'].file.path else 1)
-        ).with_cache()
+        # Create the DataPipe and convert the output to (Image, Label). Either the
+        #   images are decoded and resized once into memory-mapped shards, or the raw
+        #   file content is cached (bounded in bytes, spilling to disk) and decoded on
+        #   access.
+        datapipe = PfsFileDataPipe(
+            client,
+            commit,
+            previous_commit=previous_commit,
+            index_dir=os.path.join(self.download_directory, "index"),
+        )
+        if incremental:
+            datapipe.sync(os.path.join(MIRROR_DIR or self.download_directory, project, repo, branch))
+        elif data_config.get("prefetch"):
+            datapipe.prefetch(self.download_directory)
+        paths = [datapipe.path(idx) for idx in range(len(datapipe))]
+        if data_config.get("read_ahead"):
+            return self.create_read_ahead_datasets(datapipe, paths)
+        files = datapipe.map(
+            lambda item: (item['file'].read(), 0 if "dog" in item['info'].file.path else 1)
+        )
+        pre_resized = bool(data_config.get("image_shards"))
+        if pre_resized:
+            # Shards are specific to the commit (and previous commit) indexed, and
+            #   shared by the ranks of a node: one of them writes, the others wait.
+            shards_dir = os.path.join(
+                MIRROR_DIR or "/tmp/dog-cat", "shards", project, repo, datapipe.version
+            )
+            self.cache = None
+            datapipe = open_image_shards(files, shards_dir)
+            paths = [paths[datapipe.source(idx)] for idx in range(len(datapipe))]
+        else:
+            spill_dir = None
+            if data_config.get("cache_max_disk_bytes"):
+                spill_dir = os.path.join(self.download_directory, "cache")
+            self.cache = files.with_cache(
+                max_bytes=data_config.get("cache_max_bytes"),
+                spill_dir=spill_dir,
+                max_disk_bytes=data_config.get("cache_max_disk_bytes"),
+                backend=data_config.get("cache_backend") or "local",
+                # One arena per commit indexed; the arenas of previous commits are
+                #   removed once no process uses them.
+                shared_path=os.path.join(
+                    "/dev/shm/dog-cat", project, repo, branch, datapipe.version
+                ),
+                # The training and validation loaders each run their own workers.
+                num_workers=2 * int(self.context.get_hparams().get("num_workers", 0)),
+            )
+            datapipe = self.cache.map(
+                lambda item: (Image.open(io.BytesIO(item[0])).convert("RGB"), item[1])
+            )
 
         print(f"Creating datasets from {len(datapipe)} input files")
-        train_size = round(0.81 * len(datapipe))
-        val_size = len(datapipe) - train_size
-        train, validate = random_split(datapipe, [train_size, val_size])
+        train_indices, val_indices = hash_split(paths, data_config.get("validation_ratio", 0.19))
+        train_size, val_size = len(train_indices), len(val_indices)
+        train, validate = Subset(datapipe, train_indices), Subset(datapipe, val_indices)
 
         print("setting transform for training dataset")
-        train = Mapper(train, self.get_test_transforms())
-        validate = Mapper(validate, self.get_train_transforms())
+        train = Mapper(train, self.get_transforms(pre_resized))
+        validate = Mapper(validate, self.get_transforms(pre_resized))
 
         print(f"Datasets created: train_size={train_size}, val_size={val_size}")
         return train, validate
 
     # -------------------------------------------------------------------------
 
-    def get_train_transforms(self) -> Callable[[DogCatItem], DogCatItem]:
-        transform = transforms.Compose(
-            [
-                transforms.Resize(240),
-                transforms.RandomCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]
-        )
-
-        def wrapper(image_label: DogCatItem) -> DogCatItem:
-            image, label = image_label
-            return transform(image), label
-        return wrapper
+    def create_read_ahead_datasets(
+        self, datapipe: PfsFileDataPipe, paths: List[str]
+    ) -> Tuple[Dataset, Dataset]:
+        # The files are streamed in sampling order and read ahead on a thread pool per
+        #   process: every rank reads its share of the indices, and every DataLoader
+        #   worker 1/N of that share.
+        data_config = self.context.get_data_config()
+        self.cache = None
+        train_indices, val_indices = hash_split(paths, data_config.get("validation_ratio", 0.19))
+        rank, size = self.context.distributed.get_rank(), self.context.distributed.get_size()
+        options = {
+            "window": int(data_config.get("read_ahead_window") or 16),
+            "max_bytes": data_config.get("read_ahead_max_bytes"),
+        }
+        train = PfsPrefetchDataPipe(datapipe, EpochShuffle(train_indices[rank::size]), **options)
+        validate = PfsPrefetchDataPipe(datapipe, val_indices[rank::size], **options)
+
+        def decode(item):
+            image = Image.open(io.BytesIO(item['file'].read())).convert("RGB")
+            return image, 0 if "dog" in item['info'].file.path else 1
+
+        print(f"Datasets created: train_size={len(train)}, val_size={len(validate)} (rank {rank})")
+        transform = self.get_transforms()
+        return train.map(decode).map(transform), validate.map(decode).map(transform)
 
     # -------------------------------------------------------------------------
 
-    def get_test_transforms(self) -> Callable[[DogCatItem], DogCatItem]:
-        transform = transforms.Compose(
-            [
-                transforms.Resize(240),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]
-        )
+    def get_transforms(self, pre_resized: bool = False) -> Callable[[DogCatItem], DogCatItem]:
+        # Items are collated as (3, 240, 240) uint8 tensors. Cropping, flipping and
+        #   normalization run on whole batches in train_batch/evaluate_batch.
+        if pre_resized:
+            # Images read from shards are already (240, 240, 3) uint8 arrays.
+            def transform(image):
+                return torch.from_numpy(image).permute(2, 0, 1)
+        else:
+            transform = transforms.Compose(
+                [
+                    transforms.Resize(240),
+                    transforms.CenterCrop(240),
+                    transforms.PILToTensor(),
+                ]
+            )
 
         def wrapper(image_label: DogCatItem) -> DogCatItem:
             image, label = image_label
@@ -175,19 +342,45 @@ class DogCatModel(PyTorchTrial):
     # -------------------------------------------------------------------------
 
     def predict(
-        self, X: np.ndarray, names, meta
+        self, X: Union[np.ndarray, List[np.ndarray]], names, meta
     ) -> Union[np.ndarray, List, str, bytes, Dict]:
-        image = Image.fromarray(X.astype(np.uint8))
-        logging.info(f"Image size : {image.size}")
-
-        image = self.get_test_transforms()(image)
-        image = image.unsqueeze(0)
+        """Returns the labels of a batch of images, with a single forward pass.
 
-        with torch.no_grad():
-            output = self.model(image)[0]
-            pred = np.argmax(output)
-            logging.info(f"Prediction is : {pred}")
-
-        return [self.labels[pred]]
+        X is an (N, H, W, C) array, a list of (H, W[, C]) arrays of any sizes, or a
+          single (H, W[, C]) image. Grayscale images are repeated to 3 channels.
+        """
+        if isinstance(X, np.ndarray) and X.ndim == 2:
+            X = X[np.newaxis, ..., np.newaxis]
+        elif isinstance(X, np.ndarray) and X.ndim == 3:
+            X = X[np.newaxis]
+        if self.predict_transform is None:
+            self.predict_transform = transforms.Compose(
+                [transforms.Resize(240, antialias=True), transforms.CenterCrop(240)]
+            )
+
+        if isinstance(X, np.ndarray):
+            images = self.predict_transform(to_uint8_chw(X))
+        else:
+            images = torch.stack([self.predict_transform(to_uint8_chw(x)) for x in X])
+        logging.info(f"Batch size : {len(images)}")
+
+        device = next(self.model.parameters()).device
+        self.model.eval()
+        with torch.inference_mode(), torch.autocast(device.type, enabled=self.amp):
+            output = self.model(self.prepare(images.to(device), train=False))
+            preds = output.argmax(dim=1).tolist()
+        logging.info(f"Predictions are : {preds}")
+
+        return [self.labels[pred] for pred in preds]
+
+
+def to_uint8_chw(images: np.ndarray) -> Tensor:
+    """Converts (..., H, W[, C]) images to (..., 3, H, W) uint8 RGB tensors."""
+    images = np.asarray(images).astype(np.uint8, copy=False)
+    if images.ndim == 2:
+        images = images[..., np.newaxis]
+    if images.shape[-1] == 1:
+        images = np.repeat(images, 3, axis=-1)
+    return torch.from_numpy(np.ascontiguousarray(images[..., :3])).movedim(-1, -3)
 
 # =============================================================================
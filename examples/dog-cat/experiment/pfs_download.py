@@ -0,0 +1,932 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import grpc
+import pachyderm_sdk
+from pachyderm_sdk import client as pach_client
+from pachyderm_sdk.api.pfs import Commit, File, FileInfo, FileType, PathRange
+from pachyderm_sdk.api.pfs.file import PFSFile, PFSTarFile
+from pachyderm_sdk.constants import GRPC_CHANNEL_OPTIONS
+
+# Maximum number of concurrent calls lent on one gRPC channel by the ClientPool.
+MAX_STREAMS_PER_CHANNEL = int(os.environ.get("PACH_GRPC_MAX_STREAMS", "4"))
+
+# Keepalive pings let idle channels survive (e.g. between two epochs) behind
+#   load balancers and NATs instead of paying a new TLS/auth handshake.
+GRPC_OPTIONS = GRPC_CHANNEL_OPTIONS + [
+    ("grpc.keepalive_time_ms", int(os.environ.get("PACH_GRPC_KEEPALIVE_MS", "30000"))),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+# Number of files transferred in parallel.
+DEFAULT_CONCURRENCY = int(os.environ.get("PACH_DOWNLOAD_CONCURRENCY", "8"))
+
+# Seconds between two progress reports.
+PROGRESS_INTERVAL = float(os.environ.get("PACH_DOWNLOAD_PROGRESS_INTERVAL", "10"))
+
+# Fetch whole ranges of files as TAR streams instead of one GetFile call per file.
+BULK_DOWNLOAD = os.environ.get("PACH_DOWNLOAD_BULK", "false").lower() == "true"
+
+COPY_BUFSIZE = 1024 * 1024
+
+# Persistent, node-local cache of PFS files. Disabled unless PACH_CACHE_DIR is set;
+#   it should point to a host directory bind-mounted in the task containers.
+CACHE_DIR = os.environ.get("PACH_CACHE_DIR")
+CACHE_MAX_BYTES = int(os.environ.get("PACH_CACHE_MAX_BYTES", str(100 * 2**30)))
+
+# Files at least this large are downloaded to a partial file kept across attempts,
+#   so a preempted trial resumes them with ranged reads instead of starting over.
+RESUME_MIN_BYTES = int(os.environ.get("PACH_DOWNLOAD_RESUME_MIN_BYTES", str(16 * 2**20)))
+
+# Node-local directory holding the materialized copy of the repositories synced in
+#   incremental mode. It should point to a host directory bind-mounted in the task
+#   containers; the download directory is synced in place when it is not set.
+MIRROR_DIR = os.environ.get("PACH_MIRROR_DIR")
+
+# Directory of the download journals and partial files (see DownloadJournal), which
+#   must outlive the download directory for a restarted trial to reuse them. Defaults
+#   to the journals subdirectory of PACH_CACHE_DIR or PACH_MIRROR_DIR; when none of
+#   them is set, the journal is kept in the download directory itself.
+JOURNAL_DIR = os.environ.get("PACH_JOURNAL_DIR") or next(
+    (os.path.join(d, "journals") for d in (CACHE_DIR, MIRROR_DIR) if d), None
+)
+
+# Shared locks on the mirror snapshots used by this process, held until it exits.
+_SNAPSHOT_LOCKS: Dict[str, object] = {}
+
+# Re-hash the files listed in the download journal before skipping them.
+VERIFY_DOWNLOADS = os.environ.get("PACH_DOWNLOAD_VERIFY", "true").lower() == "true"
+
+# ioctl request to clone a file on copy-on-write filesystems (linux/fs.h).
+FICLONE = 0x40049409
+
+
+def safe_open_wb(path):
+    ''' Open "path" for writing, creating any parent directories as needed.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, 'wb')
+
+
+def create_client(host: str, port: int, token: Optional[str]) -> pachyderm_sdk.Client:
+    """Creates a Client whose channel is configured with GRPC_OPTIONS."""
+    client = pachyderm_sdk.Client(host=host, port=port, auth_token=token)
+    # pachyderm_sdk does not expose the channel options, so the channel is rebuilt
+    #   (channels connect lazily: the discarded one never opened a connection).
+    client._channel.close()
+    channel = pach_client._create_channel(client.address, client.root_certs, options=GRPC_OPTIONS)
+    client._channel = pach_client._apply_metadata_interceptor(channel, client._metadata)
+    client._init_api()
+    return client
+
+
+class ClientPool:
+    """Process-wide pool of Clients (i.e. gRPC channels), per pachd and token.
+
+    lend() hands out a client running fewer than max_streams calls lent by the pool,
+      and opens a new channel when all of them are busy. get() returns the first
+      channel, for long-lived streams or occasional calls.
+
+    gRPC channels cannot be used across fork(): a forked child (e.g. a DataLoader
+      worker) drops the channels inherited from its parent and opens its own.
+    """
+
+    def __init__(self, max_streams: int = MAX_STREAMS_PER_CHANNEL):
+        self.max_streams = max_streams
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._channels: Dict[Tuple[str, str, Optional[str]], List[list]] = {}
+
+    def _entries(self, host: str, port: int, token: Optional[str]) -> List[list]:
+        if self._pid != os.getpid():
+            self._reset()
+        return self._channels.setdefault((host, str(port), token), [])
+
+    def get(self, host: str, port: int, token: Optional[str]) -> pachyderm_sdk.Client:
+        with self._lock:
+            entries = self._entries(host, port, token)
+            if not entries:
+                entries.append([create_client(host, port, token), 0])
+            return entries[0][0]
+
+    @contextmanager
+    def lend(self, host: str, port: int, token: Optional[str]) -> Iterator[pachyderm_sdk.Client]:
+        with self._lock:
+            entries = self._entries(host, port, token)
+            entry = min(entries, key=lambda e: e[1], default=None)
+            if entry is None or entry[1] >= self.max_streams:
+                entry = [create_client(host, port, token), 0]
+                entries.append(entry)
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+
+
+CLIENT_POOL = ClientPool()
+
+
+def get_client(host: str, port: int, token: Optional[str]) -> pachyderm_sdk.Client:
+    """Returns the pooled Client of this process for the given pachd and token."""
+    return CLIENT_POOL.get(host, port, token)
+
+
+def split_address(client: pachyderm_sdk.Client) -> Tuple[str, int]:
+    host, port = client.address.rsplit(":", 1)
+    return host, int(port)
+
+
+def iter_pach_files(
+    client: pachyderm_sdk.Client,
+    project: str,
+    repo: str,
+    branch: str,
+    previous_commit: Optional[str] = None,
+) -> Iterator[FileInfo]:
+    """Yields the FileInfo of every file of {project}/{repo}@{branch}.
+
+    If previous_commit is specified, only the files added or modified since
+      previous_commit are yielded.
+    """
+    new_file = File.from_uri(f"{project}/{repo}@{branch}")
+    if previous_commit is not None:
+        old_file = File.from_uri(f"{project}/{repo}@{previous_commit}")
+        infos = (diff.new_file for diff in client.pfs.diff_file(new_file=new_file, old_file=old_file))
+    else:
+        infos = client.pfs.walk_file(file=new_file)
+
+    for info in infos:
+        if info.file_type == FileType.FILE and info.file.path != "":
+            yield info
+
+
+class TarShard(NamedTuple):
+    """A contiguous range of PFS paths fetched with a single GetFileTAR call.
+
+    paths maps the paths to extract from the range to their FileInfo.
+    """
+    file: File
+    path_range: PathRange
+    paths: Dict[str, FileInfo]
+
+
+def make_shards(infos: List[FileInfo], num_shards: int) -> List[TarShard]:
+    """Splits infos into at most num_shards path ranges of roughly equal size in bytes.
+
+    Ranges are [lower, upper) intervals of the sorted paths; the last one is unbounded.
+    """
+    infos = sorted(infos, key=lambda info: info.file.path)
+    total = sum(info.size_bytes for info in infos)
+    root_file = File(commit=infos[0].file.commit, path="/")
+
+    groups, group, group_bytes = [], [], 0
+    for info in infos:
+        group.append(info)
+        group_bytes += info.size_bytes
+        if group_bytes * num_shards >= total * (len(groups) + 1) and len(groups) < num_shards - 1:
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+
+    shards = []
+    for i, group in enumerate(groups):
+        upper = groups[i + 1][0].file.path if i + 1 < len(groups) else ""
+        shards.append(TarShard(
+            file=root_file,
+            path_range=PathRange(lower=group[0].file.path, upper=upper),
+            paths={info.file.path: info for info in group},
+        ))
+    return shards
+
+
+def link_or_copy(src_path: str, des_path: str) -> None:
+    """Makes des_path a hard link of src_path, or a reflink/copy across filesystems."""
+    os.makedirs(os.path.dirname(des_path), exist_ok=True)
+    if os.path.lexists(des_path):
+        os.remove(des_path)
+    try:
+        os.link(src_path, des_path)
+        return
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    with open(src_path, "rb") as src_file, open(des_path, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            shutil.copyfileobj(src_file, dest_file, COPY_BUFSIZE)
+
+
+def move_file(src_path: str, des_path: str) -> None:
+    """Atomically replaces des_path with src_path, copying across filesystems."""
+    try:
+        os.replace(src_path, des_path)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    tmp_path = f"{des_path}.tmp-{uuid.uuid4().hex}"
+    try:
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, des_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    os.remove(src_path)
+
+
+def hash_file(path: str, digest) -> int:
+    """Feeds the content of path to digest. Returns the number of bytes read."""
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_BUFSIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def copy_and_hash(src_file, dest_file, digest) -> None:
+    while chunk := src_file.read(COPY_BUFSIZE):
+        dest_file.write(chunk)
+        digest.update(chunk)
+
+
+class PachFileCache:
+    """Content-addressed cache of PFS files, keyed by FileInfo.hash.
+
+    Cached files are linked into the download directories, so retraining on a
+      commit that differs by a few files only transfers the files that changed,
+      whatever the trial, rank or pipeline run. Files must therefore be treated as
+      read-only once downloaded.
+
+    Entries are evicted in least-recently-used order (the modification time of an
+      entry is refreshed on every hit) when the cache grows beyond max_bytes.
+      Several processes can share the same cache directory: entries are written to
+      a temporary file and atomically renamed in place.
+
+    The SHA-256 of an entry, computed while it was downloaded, is kept in
+      digests/<hash>, so linking an entry does not require reading it again.
+    """
+
+    def __init__(self, root: str, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(root, "objects")
+        self._tmp = os.path.join(root, "tmp")
+        self._digests = os.path.join(root, "digests")
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._digests, exist_ok=True)
+        os.makedirs(self._tmp, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["PachFileCache"]:
+        return cls(CACHE_DIR) if CACHE_DIR else None
+
+    def path(self, info: FileInfo) -> Optional[str]:
+        """Returns the location of the cache entry of info (None if it has no hash)."""
+        if not info.hash:
+            return None
+        key = info.hash.hex()
+        return os.path.join(self._objects, key[:2], key)
+
+    def get(self, info: FileInfo, des_path: str) -> bool:
+        """Links the cached copy of info to des_path. Returns False on a cache miss."""
+        path = self.path(info)
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            os.utime(path)
+            link_or_copy(path, des_path)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime.
+            return False
+        return True
+
+    def digest(self, info: FileInfo) -> Optional[str]:
+        """Returns the SHA-256 hex digest of the cache entry of info, if recorded."""
+        try:
+            with open(os.path.join(self._digests, info.hash.hex())) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def temp_path(self) -> str:
+        return os.path.join(self._tmp, uuid.uuid4().hex)
+
+    def put(self, info: FileInfo, tmp_path: str, des_path: str, digest: Optional[str] = None) -> None:
+        """Moves the downloaded tmp_path into the cache and links it to des_path."""
+        path = self.path(info)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if digest is not None:
+            digest_tmp = self.temp_path()
+            with open(digest_tmp, "w") as f:
+                f.write(digest)
+            os.replace(digest_tmp, os.path.join(self._digests, info.hash.hex()))
+        move_file(tmp_path, path)
+        link_or_copy(path, des_path)
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        entries, total = [], 0
+        for dirpath, _, filenames in os.walk(self._objects):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            for entry_path in (path, os.path.join(self._digests, os.path.basename(path))):
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            evicted += 1
+        if evicted:
+            print(f"Evicted {evicted} files from {self.root}, {total / 2**20:.1f} MiB left")
+
+
+class DownloadJournal:
+    """Record of the files completely downloaded below root, kept across attempts.
+
+    Every completed file is appended to the journal with its PFS hash, its size and
+      the SHA-256 of the local copy. A file is skipped on the next attempt if its PFS
+      hash and size did not change and (if verify) the local copy still matches its
+      SHA-256. A line cut short by a crash is ignored.
+
+    Large files are downloaded to a partial file named after their path and PFS hash
+      and moved in place once complete, so an interrupted download is resumed where it
+      stopped.
+
+    The journal and the partial files are kept in state_dir (JOURNAL_DIR by default),
+      in a subdirectory named after the hash of the absolute path of root, or in
+      root itself (.pach-journal and .pach-partial) if state_dir is None. The
+      subdirectory is locked until the journal is closed: another process journaling
+      the same path (e.g. in another container) falls back to root.
+    """
+
+    NAME = ".pach-journal"
+
+    def __init__(self, root: str, verify: bool = VERIFY_DOWNLOADS, state_dir: Optional[str] = JOURNAL_DIR):
+        self.path = os.path.join(root, self.NAME)
+        self.partial_dir = os.path.join(root, ".pach-partial")
+        self._state_lock = None
+        if state_dir is not None:
+            key = hashlib.sha256(os.fsencode(os.path.abspath(root))).hexdigest()[:32]
+            os.makedirs(state_dir, exist_ok=True)
+            lock_file = open(os.path.join(state_dir, f"{key}.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._state_lock = lock_file
+                self.path = os.path.join(state_dir, key, "journal")
+                self.partial_dir = os.path.join(state_dir, key, "partial")
+            except BlockingIOError:
+                lock_file.close()
+                print(f"The journal of {root} in {state_dir} is in use, journaling in {root}")
+        self.verify = verify
+        self._entries: Dict[str, Tuple[str, int, str]] = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split(" ", 3)
+                    if not line.endswith("\n") or len(fields) != 4:
+                        continue
+                    pfs_hash, size, digest, path = fields
+                    if pfs_hash == "-":
+                        self._entries.pop(path, None)
+                    else:
+                        self._entries[path] = (pfs_hash, int(size), digest)
+
+        # Compact the entries overwritten by later downloads.
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for path, (pfs_hash, size, digest) in self._entries.items():
+                f.write(f"{pfs_hash} {size} {digest} {path}\n")
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a")
+
+    def is_complete(self, info: FileInfo, des_path: str) -> bool:
+        entry = self._entries.get(info.file.path)
+        if entry is None or entry[:2] != (info.hash.hex(), info.size_bytes):
+            return False
+        try:
+            if os.path.getsize(des_path) != info.size_bytes:
+                return False
+        except OSError:
+            return False
+        if not self.verify:
+            return True
+        digest = hashlib.sha256()
+        hash_file(des_path, digest)
+        return digest.hexdigest() == entry[2]
+
+    def partial_path(self, info: FileInfo) -> Optional[str]:
+        """Returns where to download info if it is large enough to be resumed."""
+        if not info.hash or info.size_bytes < RESUME_MIN_BYTES:
+            return None
+        # Files of identical content have the same hash: the path tells them apart.
+        path_key = hashlib.sha1(info.file.path.encode()).hexdigest()
+        return os.path.join(self.partial_dir, f"{path_key}-{info.hash.hex()}")
+
+    def record(self, info: FileInfo, des_path: str, digest: Optional[str] = None) -> None:
+        """Marks des_path as a complete copy of info. Hashes it if digest is not given."""
+        if not info.hash:
+            return
+        if digest is None:
+            sha256 = hashlib.sha256()
+            hash_file(des_path, sha256)
+            digest = sha256.hexdigest()
+        with self._lock:
+            self._entries[info.file.path] = (info.hash.hex(), info.size_bytes, digest)
+            self._file.write(f"{info.hash.hex()} {info.size_bytes} {digest} {info.file.path}\n")
+            self._file.flush()
+
+    def forget(self, path: str) -> None:
+        """Removes the PFS path from the journal."""
+        with self._lock:
+            if self._entries.pop(path, None) is not None:
+                self._file.write(f"- 0 - {path}\n")
+                self._file.flush()
+
+    def paths(self) -> List[str]:
+        """Returns the PFS paths of the files recorded in the journal, sorted."""
+        with self._lock:
+            return sorted(self._entries)
+
+    def close(self, completed: bool = False) -> None:
+        """Closes the journal. Once completed, partial files left over are removed."""
+        self._file.close()
+        if completed:
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
+        if self._state_lock is not None:
+            self._state_lock.close()
+
+
+class DownloadProgress:
+    """Thread-safe counters of the files and bytes downloaded so far.
+
+    A throughput report is printed at most every `interval` seconds.
+    """
+
+    def __init__(self, interval: float = PROGRESS_INTERVAL):
+        self.files = 0
+        self.bytes = 0
+        self.cached = 0
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._start = self._last_report = time.monotonic()
+
+    def update(self, nbytes: int, cached: bool = False) -> None:
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+            self.cached += cached
+            now = time.monotonic()
+            if now - self._last_report >= self._interval:
+                self._last_report = now
+                self.report()
+
+    def report(self) -> None:
+        elapsed = max(time.monotonic() - self._start, 1e-6)
+        mib = self.bytes / 2**20
+        print(
+            f"Downloaded {self.files} files ({self.cached} reused), {mib:.1f} MiB "
+            f"in {elapsed:.1f}s ({self.files / elapsed:.1f} files/s, {mib / elapsed:.1f} MiB/s)"
+        )
+
+
+class PachDownloader:
+    """Downloads files from PFS with a bounded pool of worker threads.
+
+    Clients are borrowed from CLIENT_POOL: gRPC streams are multiplexed on a single
+      HTTP/2 connection per channel, so the transfers are spread over
+      concurrency / MAX_STREAMS_PER_CHANNEL channels, reused by later downloads.
+
+    Files are submitted to the pool as soon as they are listed, so listing the
+      repository and downloading its content overlap. At most 2 * concurrency
+      files are queued at any time.
+
+    If a PachFileCache is given (by default, the one configured by PACH_CACHE_DIR),
+      files whose hash is already cached are linked instead of downloaded.
+
+    Downloads are journaled (see DownloadJournal): when a trial restarts, files
+      downloaded by the previous attempt are verified and kept, and large files are
+      resumed with ranged reads.
+
+    In bulk mode, the files are instead split in `concurrency` ranges of paths and
+      every range is fetched as a single TAR stream, unpacked on the fly. This trades
+      the per-file request latency for a few long streams and bypasses the cache.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        token: Optional[str],
+        concurrency: Optional[int] = None,
+        cache: Optional[PachFileCache] = None,
+        bulk: Optional[bool] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.concurrency = max(1, int(concurrency or DEFAULT_CONCURRENCY))
+        self.cache = cache if cache is not None else PachFileCache.from_env()
+        self.bulk = BULK_DOWNLOAD if bulk is None else bulk
+
+    @classmethod
+    def from_client(cls, client: pachyderm_sdk.Client, **kwargs) -> "PachDownloader":
+        """Creates a downloader connecting to the same pachd as client."""
+        return cls(*split_address(client), client.auth_token, **kwargs)
+
+    def client(self) -> pachyderm_sdk.Client:
+        """Returns the shared Client of this process."""
+        return CLIENT_POOL.get(self.host, self.port, self.token)
+
+    def lend_client(self):
+        return CLIENT_POOL.lend(self.host, self.port, self.token)
+
+    def fetch(
+        self, info: FileInfo, des_path: str, journal: Optional[DownloadJournal] = None
+    ) -> Tuple[int, bool]:
+        """Downloads a single file to des_path.
+
+        Returns its size in bytes and whether it was reused from the journal or the cache.
+        """
+        if journal is not None and journal.is_complete(info, des_path):
+            return info.size_bytes, True
+
+        cache = self.cache if self.cache is not None and self.cache.path(info) else None
+        if cache is not None and cache.get(info, des_path):
+            if journal is not None:
+                journal.record(info, des_path, cache.digest(info))
+            return info.size_bytes, True
+
+        # Never write des_path in place: it may be a hard link shared with the cache
+        #   or a mirror snapshot.
+        part_path = journal.partial_path(info) if journal is not None else None
+        tmp_path = part_path or (
+            cache.temp_path() if cache is not None else f"{des_path}.tmp-{uuid.uuid4().hex}"
+        )
+        try:
+            size, digest = self._copy(info, tmp_path, resume=part_path is not None)
+            if cache is not None:
+                cache.put(info, tmp_path, des_path, digest)
+            else:
+                os.makedirs(os.path.dirname(des_path), exist_ok=True)
+                move_file(tmp_path, des_path)
+        finally:
+            if part_path is None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if journal is not None:
+            journal.record(info, des_path, digest)
+        return size, False
+
+    def _copy(self, info: FileInfo, des_path: str, resume: bool = False) -> Tuple[int, str]:
+        """Downloads info to des_path. Returns its size and SHA-256 hex digest.
+
+        If resume is set, the content already in des_path is kept and only the rest
+          of the file is requested.
+        """
+        digest = hashlib.sha256()
+        offset = 0
+        if resume and os.path.exists(des_path):
+            offset = hash_file(des_path, digest)
+            if offset > info.size_bytes:
+                offset, digest = 0, hashlib.sha256()
+        if offset:
+            print(f"Resuming {info.file.path} at {offset / 2**20:.1f} MiB")
+
+        os.makedirs(os.path.dirname(des_path), exist_ok=True)
+        with self.lend_client() as client:
+            stream = client.pfs.get_file(file=info.file, offset=offset)
+            with PFSFile(stream) as src_file, open(des_path, "ab" if offset else "wb") as dest_file:
+                copy_and_hash(src_file, dest_file, digest)
+                size = dest_file.tell()
+
+        if size != info.size_bytes:
+            os.remove(des_path)
+            raise IOError(f"{info.file.path}: expected {info.size_bytes} bytes, got {size}")
+        return size, digest.hexdigest()
+
+    def download(
+        self, infos: Iterable[FileInfo], root: str, journal: Optional[DownloadJournal] = None
+    ) -> List[Tuple[str, str]]:
+        """Downloads every file of infos below root, preserving the PFS paths.
+
+        Returns the list of (src_path, des_path) of the downloaded files. The first
+          error raised by a worker stops the submission of new files and is re-raised.
+          A journal given by the caller is left open.
+        """
+        owned = journal is None
+        journal = journal or DownloadJournal(root)
+        progress = DownloadProgress()
+        slots = threading.BoundedSemaphore(2 * self.concurrency)
+        errors = []
+
+        def on_done(future):
+            slots.release()
+            if future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                progress.update(*future.result())
+
+        files = []
+        # Partial files are only removed once every file is listed and downloaded.
+        completed = False
+        try:
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix="pach-download") as pool:
+                for info in infos:
+                    if errors:
+                        break
+                    src_path = info.file.path
+                    des_path = os.path.join(root, src_path[1:])
+                    files.append((src_path, des_path))
+
+                    slots.acquire()
+                    pool.submit(self.fetch, info, des_path, journal).add_done_callback(on_done)
+            completed = not errors
+        finally:
+            if owned:
+                journal.close(completed=completed)
+
+        if errors:
+            raise errors[0]
+        progress.report()
+        if self.cache is not None:
+            self.cache.evict()
+        return files
+
+    def fetch_shard(
+        self, shard: TarShard, root: str, progress: DownloadProgress, journal: DownloadJournal
+    ) -> None:
+        """Streams the TAR of shard and extracts the files it selects below root.
+
+        Raises IOError if the TAR lacks any of the files of shard.
+        """
+        missing = set(shard.paths)
+        with self.lend_client() as client:
+            stream = client.pfs.get_file_tar(file=shard.file, path_range=shard.path_range)
+            with PFSTarFile.open(fileobj=PFSFile(stream), mode="r|*") as tar:
+                for member in tar:
+                    info = shard.paths.get("/" + member.path)
+                    if not member.isfile() or info is None:
+                        continue
+                    # As in fetch, des_path may be a hard link and is replaced, not truncated.
+                    des_path = os.path.join(root, member.path)
+                    tmp_path = f"{des_path}.tmp-{uuid.uuid4().hex}"
+                    digest = hashlib.sha256()
+                    try:
+                        with safe_open_wb(tmp_path) as dest_file:
+                            copy_and_hash(tar.extractfile(member), dest_file, digest)
+                        os.replace(tmp_path, des_path)
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                    journal.record(info, des_path, digest.hexdigest())
+                    progress.update(member.size)
+                    missing.discard(info.file.path)
+
+        if missing:
+            raise IOError(
+                f"{len(missing)} files missing from the TAR of {shard.path_range.lower}, "
+                f"e.g. {min(missing)}"
+            )
+
+    def download_shards(
+        self, infos: Iterable[FileInfo], root: str, num_shards: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
+        """Downloads every file of infos below root with one GetFileTAR call per shard.
+
+        Files that fall within a shard's range without being part of infos (e.g. in
+          diff mode, or already downloaded by a previous attempt) are transferred but
+          not written.
+        """
+        infos = list(infos)
+        files = [(info.file.path, os.path.join(root, info.file.path[1:])) for info in infos]
+        journal = DownloadJournal(root)
+        infos = [info for (_, des_path), info in zip(files, infos) if not journal.is_complete(info, des_path)]
+        if not infos:
+            journal.close(completed=True)
+            return files
+
+        progress = DownloadProgress()
+        shards = make_shards(infos, num_shards or self.concurrency)
+        try:
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix="pach-download") as pool:
+                futures = [
+                    pool.submit(self.fetch_shard, shard, root, progress, journal) for shard in shards
+                ]
+            for future in futures:
+                future.result()
+        finally:
+            journal.close()
+        progress.report()
+        return files
+
+    def sync_repo(self, project: str, repo: str, branch: str, root: str) -> List[Tuple[str, str]]:
+        """Makes root a copy of {project}/{repo}@{branch}, transferring only what changed.
+
+        The commit materialized in root is recorded in root/.pach-commit. The next
+          sync applies the diff_file between that commit and the head of branch:
+          added and modified files are downloaded, deleted files are removed. Without
+          a previous commit (or if it no longer exists), the whole commit is listed,
+          the journaled files that did not change are kept and the others removed.
+          Concurrent syncs of root (e.g. by the ranks of a node) are serialized.
+
+        Returns the (src_path, des_path) of every file of the commit.
+        """
+        with self._lock_mirror(root):
+            return self._sync(project, repo, branch, root)[1]
+
+    @contextmanager
+    def _lock_mirror(self, root: str):
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, ".pach-lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _sync(
+        self, project: str, repo: str, branch: str, root: str
+    ) -> Tuple[str, List[Tuple[str, str]]]:
+        """Syncs root, locked by the caller. Returns the commit ID and the files of root."""
+        state_path = os.path.join(root, ".pach-commit")
+        client = self.client()
+        commit = Commit.from_uri(f"{project}/{repo}@{branch}")
+        commit_id = client.pfs.inspect_commit(commit=commit).commit.id
+        new_file = File.from_uri(f"{project}/{repo}@{commit_id}")
+
+        previous_id = None
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                previous_id = f.read().strip() or None
+
+        # The journal lists the files of the mirror: it is kept with them.
+        journal = DownloadJournal(root, state_dir=None)
+        try:
+            if previous_id == commit_id:
+                print(f"{root} is up to date with {project}/{repo}@{commit_id}")
+                return commit_id, [(path, os.path.join(root, path[1:])) for path in journal.paths()]
+
+            added, deleted = None, []
+            if previous_id is not None:
+                old_file = File.from_uri(f"{project}/{repo}@{previous_id}")
+                try:
+                    added = []
+                    for diff in client.pfs.diff_file(new_file=new_file, old_file=old_file):
+                        if diff.new_file.file_type == FileType.FILE:
+                            added.append(diff.new_file)
+                        elif diff.old_file.file_type == FileType.FILE:
+                            deleted.append(diff.old_file.file.path)
+                except grpc.RpcError as err:
+                    print(f"Cannot diff with {previous_id} ({err.code()}), syncing all files")
+                    added, deleted = None, []
+
+            if added is None:
+                added = list(iter_pach_files(client, project, repo, commit_id))
+                listed = {info.file.path for info in added}
+                deleted = [path for path in journal.paths() if path not in listed]
+
+            print(
+                f"Syncing {root} from {previous_id} to {commit_id}: "
+                f"{len(added)} files to check, {len(deleted)} to delete"
+            )
+            for path in deleted:
+                journal.forget(path)
+                des_path = os.path.join(root, path[1:])
+                if os.path.lexists(des_path):
+                    os.remove(des_path)
+                try:
+                    os.removedirs(os.path.dirname(des_path))
+                except OSError:
+                    pass
+            self.download(added, root, journal)
+
+            tmp_path = state_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(commit_id)
+            os.replace(tmp_path, state_path)
+            return commit_id, [(path, os.path.join(root, path[1:])) for path in journal.paths()]
+        finally:
+            journal.close()
+
+    def sync_snapshot(
+        self, project: str, repo: str, branch: str, base: str
+    ) -> Tuple[str, List[Tuple[str, str]]]:
+        """Syncs the mirror base/current of {project}/{repo}@{branch} and snapshots it.
+
+        The snapshot, base/snapshots/<commit ID>, is made of hard links to the files
+          of the mirror. Later syncs replace or remove the files of the mirror but
+          never modify them in place, so a snapshot does not change while a trial
+          reads it. This process holds a shared lock on its snapshot until it exits;
+          every sync deletes the snapshots that no process holds anymore. base should
+          be specific to the branch, so that syncs of other branches do not fight
+          over the same mirror.
+
+        Returns the snapshot directory and the (src_path, des_path) of its files.
+        """
+        mirror = os.path.join(base, "current")
+        snapshots = os.path.join(base, "snapshots")
+        os.makedirs(snapshots, exist_ok=True)
+        with self._lock_mirror(mirror):
+            commit_id, files = self._sync(project, repo, branch, mirror)
+            snapshot = os.path.join(snapshots, commit_id)
+            if not os.path.exists(snapshot):
+                tmp_dir = f"{snapshot}.tmp-{os.getpid()}"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                for src_path, mirror_path in files:
+                    link_or_copy(mirror_path, os.path.join(tmp_dir, src_path[1:]))
+                os.rename(tmp_dir, snapshot)
+
+            lock_path = f"{snapshot}.lock"
+            if lock_path not in _SNAPSHOT_LOCKS:
+                lock = open(lock_path, "a")
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                _SNAPSHOT_LOCKS[lock_path] = lock
+
+            # Snapshots are only locked with the mirror locked: one that cannot be
+            #   locked exclusively now is in use.
+            for name in os.listdir(snapshots):
+                path = os.path.join(snapshots, name)
+                if name.endswith(".lock") or path == snapshot:
+                    continue
+                if ".tmp-" in name:
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                with open(f"{path}.lock", "a") as other:
+                    try:
+                        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    shutil.rmtree(path, ignore_errors=True)
+                    os.remove(f"{path}.lock")
+        return snapshot, [(src_path, os.path.join(snapshot, src_path[1:])) for src_path, _ in files]
+
+    def download_repo(
+        self,
+        project: str,
+        repo: str,
+        branch: str,
+        root: str,
+        previous_commit: Optional[str] = None,
+        incremental: bool = False,
+    ) -> List[Tuple[str, str]]:
+        """Downloads {project}/{repo}@{branch} (or its diff with previous_commit) to root.
+
+        In incremental mode, previous_commit is ignored: the repository is synced in
+          place in root (see sync_repo), or, if MIRROR_DIR is set, to a node-local
+          mirror of the branch whose snapshot (see sync_snapshot) is symlinked into
+          root. Every file of branch is returned, while only the delta since the last
+          sync is transferred.
+        """
+        os.makedirs(root, exist_ok=True)
+        if incremental:
+            if not MIRROR_DIR:
+                return self.sync_repo(project, repo, branch, root)
+            _, files = self.sync_snapshot(
+                project, repo, branch, os.path.join(MIRROR_DIR, project, repo, branch)
+            )
+            links = []
+            for src_path, mirror_path in files:
+                des_path = os.path.join(root, src_path[1:])
+                os.makedirs(os.path.dirname(des_path), exist_ok=True)
+                if os.path.lexists(des_path):
+                    os.remove(des_path)
+                os.symlink(mirror_path, des_path)
+                links.append((src_path, des_path))
+            return links
+
+        infos = iter_pach_files(self.client(), project, repo, branch, previous_commit)
+        if self.bulk:
+            return self.download_shards(infos, root)
+        return self.download(infos, root)
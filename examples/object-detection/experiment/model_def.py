@@ -151,32 +151,38 @@ class ObjectDetectionTrial(PyTorchTrial):
         self.hparams = AttrDict(self.context.get_hparams())
         print(self.hparams)
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # In serving mode, only the architecture is needed to load the checkpoint.
+        serving = os.environ.get("SERVING_MODE") == "true"
 
-        print("Download Dataset from Pachyderm...")
         self.download_directory = (f"/tmp/data-rank{self.context.distributed.get_rank()}")
 
         data_config = self.context.get_data_config()
 
-        if len(data_config.keys()) > 0:
-            data_dir = self.download_data()
-            print("===> DATA DIR: ", data_dir)
+        if not serving:
+            print("Download Dataset from Pachyderm...")
+            if len(data_config.keys()) > 0:
+                data_dir = self.download_data()
+                print("===> DATA DIR: ", data_dir)
 
-        repo_folder = get_pach_repo_folder(
-            data_config["pachyderm"]["host"],
-            data_config["pachyderm"]["port"],
-            data_config["pachyderm"]["repo"],
-            data_config["pachyderm"]["branch"],
-            data_config["pachyderm"]["token"],
-            data_config["pachyderm"]["project"])
+            repo_folder = get_pach_repo_folder(
+                data_config["pachyderm"]["host"],
+                data_config["pachyderm"]["port"],
+                data_config["pachyderm"]["repo"],
+                data_config["pachyderm"]["branch"],
+                data_config["pachyderm"]["token"],
+                data_config["pachyderm"]["project"])
 
-        self.curr_folder = repo_folder
+            self.curr_folder = repo_folder
 
 
         # define model
         print("self.hparams[model]: ",self.hparams['model'] )
         if self.hparams['model'] == 'fasterrcnn_resnet50_fpn':
-            pretrained_model = download_pretrained_model(self.hparams['pretrained_model'], "frcnn_xview.pth")
-            model = build_frcnn_model_finetune(3,ckpt=pretrained_model)
+            if serving:
+                model = build_frcnn_model_finetune(3,pretrained=False)
+            else:
+                pretrained_model = download_pretrained_model(self.hparams['pretrained_model'], "frcnn_xview.pth")
+                model = build_frcnn_model_finetune(3,ckpt=pretrained_model)
 
         model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
         print("Converted all BatchNorm*D layers in the model to torch.nn.SyncBatchNorm layers.")
@@ -188,6 +194,8 @@ class ObjectDetectionTrial(PyTorchTrial):
 
         # wrap model
         self.model = self.context.wrap_model(model)
+        if serving:
+            return
 
         # wrap optimizer
         optimizer = torch.optim.SGD(
@@ -235,6 +243,7 @@ class ObjectDetectionTrial(PyTorchTrial):
                 data_config["pachyderm"]["token"],
                 data_config["pachyderm"]["project"],
                 data_config["pachyderm"]["previous_commit"],
+                incremental=data_config["pachyderm"].get("incremental", False),
             )
             print(f"Data dir set to : {data_dir}")
 
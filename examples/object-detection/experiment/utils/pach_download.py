@@ -1,16 +1,8 @@
 
-import os
-import shutil
-
-import pachyderm_sdk
 from pachyderm_sdk.api.pfs import File, FileType
 
+from utils.pfs_download import PachDownloader, get_client
 
-def safe_open_wb(path):
-    ''' Open "path" for writing, creating any parent directories as needed.
-    '''
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    return open(path, 'wb')
 
 def get_pach_repo_folder(
     pachyderm_host,
@@ -24,9 +16,7 @@ def get_pach_repo_folder(
 
     print(f"Starting to download dataset: {repo}@{branch}")
 
-    client = pachyderm_sdk.Client(
-        host=pachyderm_host, port=pachyderm_port, auth_token=token
-    )
+    client = get_client(pachyderm_host, pachyderm_port, token)
 
     for file_info in client.pfs.walk_file(file=File.from_uri(f"{project}/{repo}@{branch}")):
             src_path = file_info.file.path
@@ -48,25 +38,13 @@ def download_full_pach_repo(
     token,
     project="default",
     previous_commit=None,
+    concurrency=None,
+    incremental=False,
 ):
     print(f"Starting to download dataset: {repo}@{branch} --> {root}")
 
-    if not os.path.exists(root):
-        os.makedirs(root)
-
-    client = pachyderm_sdk.Client(
-        host=pachyderm_host, port=pachyderm_port, auth_token=token
-    )
-
-    for file_info in client.pfs.walk_file(file=File.from_uri(f"{project}/{repo}@{branch}")):
-            src_path = file_info.file.path
-            des_path = os.path.join(root, src_path[1:])
-            print(f"Saving File: '{des_path}'")
+    downloader = PachDownloader(pachyderm_host, pachyderm_port, token, concurrency)
+    downloader.download_repo(project, repo, branch, root, incremental=incremental)
 
-            if file_info.file_type == FileType.FILE:
-                if src_path != "":
-                    src_file = client.pfs.pfs_file(file=File.from_uri(f"{project}/{repo}@{branch}:{src_path}"))
-                    with safe_open_wb(des_path) as dest_file:
-                        shutil.copyfileobj(src_file, dest_file)
     print("Download operation ended")
-    return root
\ No newline at end of file
+    return root
@@ -156,6 +156,7 @@ class FinBERTPyTorch(PyTorchTrial):
             data_config["pachyderm"]["token"],
             data_config["pachyderm"]["project"],
             data_config["pachyderm"]["previous_commit"],
+            incremental=data_config["pachyderm"].get("incremental", False),
         )
         print(f"Data dir set to : {data_dir}")
 